@@ -52,15 +52,42 @@ class ScoreLayer( Layer ):
         self.lvl.position=(660,0)
         self.add( self.lvl)
 
+        # every text assignment relayouts the label
+        self.relayouts = 0              # in the current frame
+        self.relayouts_last_frame = 0
+        self.relayouts_total = 0
+
+    def on_enter( self ):
+        super( ScoreLayer, self).on_enter()
+        state.add_observer( self.on_state_change )
+        for name in ('score', 'lives', 'farts', 'level_idx'):
+            self.on_state_change( name, getattr( state, name ) )
+
+    def on_exit( self ):
+        super( ScoreLayer, self).on_exit()
+        state.remove_observer( self.on_state_change )
+
+    def on_state_change( self, name, value ):
+        if name == 'score':
+            self.set_text( self.score, 'Score:%d' % value )
+        elif name == 'lives':
+            self.set_text( self.lives, 'Lives:%d' % value )
+        elif name == 'farts':
+            self.set_text( self.farts, 'Farts:%d' % value )
+        elif name == 'level_idx':
+            self.set_text( self.lvl, 'Lvl:%d' % (value or 0) )
+
+    def set_text( self, label, text ):
+        if label.element.text != text:
+            label.element.text = text
+            self.relayouts += 1
+            self.relayouts_total += 1
+
     def draw(self):
         super( ScoreLayer, self).draw()
-        self.score.element.text = 'Score:%d' % state.score 
-        self.lives.element.text = 'Lives:%d' % state.lives
-        self.farts.element.text = 'Farts:%d' % state.farts
+        self.relayouts_last_frame = self.relayouts
+        self.relayouts = 0
 
-        lvl = state.level_idx or 0
-        self.lvl.element.text = 'Lvl:%d' % lvl
-        
 
 class MessageLayer( Layer ):
     def show_message( self, msg, callback=None ):
@@ -0,0 +1,188 @@
+'''Micro benchmarks.
+
+Usage:
+    python run_game.py --microbench=<name>
+
+Benchmarks that don't need GL can be run without a display adding --headless.
+'''
+
+import os
+import glob
+import time
+
+import data
+
+__all__ = [ 'benchmarks', 'main' ]
+
+
+def best_time( func, repeat=5 ):
+    '''Returns the best wall time, in seconds, of calling func() `repeat` times'''
+    best = None
+    for i in xrange( repeat ):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+#
+# Level parsers
+#
+def bench_parsers():
+    '''minidom vs iterparse SVGBox2dParser, on every file in data/levels'''
+    import svg_box2d_parser
+
+    print '%-20s %12s %12s %8s %6s' % ('level', 'minidom ms', 'iterparse ms', 'speedup', 'same')
+    for path in sorted( glob.glob( data.filepath('levels/*.svg') ) ):
+        level = os.path.join( 'levels', os.path.basename(path) )
+        minidom = svg_box2d_parser.SVGBox2dParser( None, level )
+        iterparse = svg_box2d_parser.SVGBox2dIterParser( None, level )
+
+        t1 = best_time( lambda: minidom.parse_svg( path ) )
+        t2 = best_time( lambda: iterparse.parse_svg( path ) )
+        same = minidom.parse_svg( path ).ops == iterparse.parse_svg( path ).ops
+        print '%-20s %12.3f %12.3f %8.2f %6s' % ( os.path.basename(path), t1 * 1000, t2 * 1000, t1 / max(t2, 1e-9), same )
+
+
+#
+# Debug draw
+#
+def bench_circles():
+    '''fwDebugDraw.DrawSolidCircle called for 1,000 circles per frame.
+    Measures the vertex generation (CPU side), not the GL upload'''
+    import Box2D as box2d
+    from box2d_callbacks import fwDebugDraw
+
+    debug_draw = fwDebugDraw( 52 )
+    axis = box2d.b2Vec2( 1, 0 )
+    color = box2d.b2Color( 0.5, 0.9, 0.5 )
+    centers = [ (i % 40, i / 40) for i in xrange(1000) ]
+
+    def frame():
+        for x, y in centers:
+            debug_draw.DrawSolidCircle( box2d.b2Vec2(x, y), 0.5, axis, color )
+        debug_draw.triangles.clear()
+        debug_draw.lines.clear()
+
+    t = best_time( frame )
+    print '1000 circles: %.3f ms per frame, %.0f circles/sec' % ( t * 1000, 1000 / max(t, 1e-9) )
+
+
+#
+# SVG sprites
+#
+def bench_svg_batch():
+    '''1 to 500 bad guys drawn as one SVG_CacheNode each (how the game did it)
+    vs SVGnodes in one SVG_BatchNode. Needs a display'''
+    import random
+    import cocos
+    from cocos.director import director
+    from pyglet.gl import glFinish
+    import squirtle_cocos_adaptor as sqa
+
+    director.init( width=800, height=600, visible=False )
+    filename = data.filepath( 'sprites/badguy-character.svg' )
+
+    def place( node ):
+        node.position = ( random.uniform(0, 800), random.uniform(0, 600) )
+        node.rotation = random.uniform( 0, 360 )
+
+    def separate( n ):
+        root = cocos.cocosnode.CocosNode()
+        for i in xrange( n ):
+            sprite = sqa.SVG_CacheNode()
+            sprite.add( sqa.SVGnode( filename ) )
+            place( sprite )
+            root.add( sprite )
+        return root
+
+    def batched( n ):
+        root = sqa.SVG_BatchNode()
+        for i in xrange( n ):
+            node = sqa.SVGnode( filename )
+            place( node )
+            root.add( node )
+        return root
+
+    def frame_time( root ):
+        root.on_enter()
+        def frame():
+            root.visit()
+            glFinish()
+        t = best_time( frame )
+        root.on_exit()
+        return t
+
+    print '%-10s %12s %12s %8s' % ('instances', 'separate ms', 'batched ms', 'speedup')
+    for n in (1, 10, 50, 100, 250, 500):
+        t1 = frame_time( separate( n ) )
+        t2 = frame_time( batched( n ) )
+        print '%-10d %12.3f %12.3f %8.2f' % ( n, t1 * 1000, t2 * 1000, t1 / max(t2, 1e-9) )
+
+    director.window.close()
+
+def bench_svg_paths():
+    '''SVG_pre_render.parse_element on the path elements of the 5 largest
+    sprite svgs, and on synthetic paths of growing size. The tessellation
+    is skipped, so this times the path parsing alone. The time per token
+    must stay flat as the paths grow: consuming the tokens with
+    list.pop(0) made it grow linearly (O(n^2) paths).'''
+    from xml.etree.cElementTree import parse, Element
+    import squirtle_core
+
+    class PathParser( squirtle_core.SVG_pre_render ):
+        '''parse_element without a file nor GL'''
+        def __init__( self, filename ):
+            self.filename = filename
+            self.bezier_points = squirtle_core.BEZIER_POINTS
+            self.circle_points = squirtle_core.CIRCLE_POINTS
+            self.bezier_coefficients = []
+            self.gradients = squirtle_core.GradientContainer()
+            self.transform = squirtle_core.Matrix( [1, 0, 0, -1, 0, 0] )
+            self.opacity = 1.0
+            self.paths = []
+
+        def end_path( self ):
+            # keep the loops, don't tessellate
+            self.path.append( self.loop )
+            self.paths.append( self.path )
+            self.path = []
+
+    def parse_paths( name, elements ):
+        parser = PathParser( name )
+        for e in elements:
+            parser.parse_element( e )
+
+    # the svgs squirtle draws (the levels go through svg_box2d_parser)
+    svgs = sorted( glob.glob( data.filepath('sprites/*.svg') ), key=os.path.getsize, reverse=True )
+
+    inputs = []
+    for path in svgs[:5]:
+        elements = [ e for e in parse( path ).getiterator() if e.tag.endswith('path') and e.get('d') ]
+        inputs.append( ( os.path.basename(path), elements ) )
+    for points in (5000, 10000, 20000, 40000):
+        # the parser takes one point per L
+        d = 'M 0,0 ' + ' '.join( 'L %d,%d' % (i, i % 7) for i in xrange(points) )
+        inputs.append( ( '(%d points)' % points, [ Element( 'path', d=d ) ] ) )
+
+    print '%-24s %8s %10s %10s' % ('svg', 'tokens', 'parse ms', 'us/token')
+    for name, elements in inputs:
+        tokens = sum( len( squirtle_core.path_token_re.findall( e.get('d') ) ) for e in elements )
+        t = best_time( lambda: parse_paths( name, elements ) )
+        print '%-24s %8d %10.3f %10.3f' % ( name, tokens, t * 1000, t * 1e6 / max(tokens, 1) )
+
+
+# name -> benchmark
+benchmarks = {
+    'parsers' : bench_parsers,
+    'circles' : bench_circles,
+    'svg_batch' : bench_svg_batch,
+    'svg_paths' : bench_svg_paths,
+    }
+
+def main( name ):
+    if name not in benchmarks:
+        print 'Unknown benchmark: %s. Available: %s' % ( name, ', '.join( sorted(benchmarks.keys()) ) )
+        return
+    benchmarks[ name ]()
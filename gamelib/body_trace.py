@@ -0,0 +1,230 @@
+'''Body state traces.
+
+The position and angle of every dynamic body, after every physics step.
+GameLayer records them with --recordTrace=<dir>.
+Values are quantized to integers. Every `keyframe_interval` frames (or
+when the set of bodies changes, or a delta doesn't fit in 16 bits) a
+keyframe stores the absolute values; the other frames store the deltas
+from the previous frame. Being deltas of quantized values, the error
+doesn't accumulate.
+
+File layout (little endian):
+
+    header      HEADER
+    frames      FRAME + payload, one per step
+                    keyframe: ids (uint16 * n), values (int32 * 3n)
+                    delta:    deltas (int16 * 3n)
+    index       frame number (uint32) and file offset (uint32) of every
+                keyframe, and the kind (int8) of every body id
+
+TraceReader memory maps the file. Seeking to a frame is a binary search
+in the keyframe index plus at most keyframe_interval deltas.
+'''
+
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from itertools import izip
+
+__all__ = [ 'TraceWriter', 'TraceReader' ]
+
+MAGIC = 'GMTR'
+VERSION = 1
+
+# magic, version, keyframe interval, position quantum, angle quantum,
+# first step, frames, body ids, keyframes, index offset
+HEADER = '<4sHHddIIIII'
+HEADER_SIZE = struct.calcsize( HEADER )
+
+# kind, number of bodies
+FRAME = '<BH'
+FRAME_SIZE = struct.calcsize( FRAME )
+KEYFRAME, DELTA = 1, 2
+
+def _to_string( a ):
+    if sys.byteorder == 'big':
+        a = array( a.typecode, a )
+        a.byteswap()
+    return a.tostring()
+
+def _from_string( typecode, s ):
+    a = array( typecode )
+    a.fromstring( s )
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+class TraceWriter( object ):
+
+    def __init__( self, path, keyframe_interval=60, position_quantum=0.001, angle_quantum=0.0001 ):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.position_quantum = position_quantum
+        self.angle_quantum = angle_quantum
+
+        self.ids = {}                   # body -> id
+        self.kinds = array( 'b' )       # id -> kind
+        self.keyframe_frames = array( 'I' )
+        self.keyframe_offsets = array( 'I' )
+        self.first_step = None
+        self.n_frames = 0
+
+        self.prev_ids = None
+        self.prev_values = None
+        self.since_keyframe = 0
+
+        self.file = open( path, 'wb' )
+        self.file.write( '\0' * HEADER_SIZE )
+
+    def add( self, step, bodies ):
+        '''bodies: (body, kind, x, y, angle) of every body to trace.
+        Steps must be consecutive.'''
+        if self.first_step is None:
+            self.first_step = step
+        elif step != self.first_step + self.n_frames:
+            raise ValueError( 'trace: expected step %d, got %d' % ( self.first_step + self.n_frames, step ) )
+
+        pq = 1.0 / self.position_quantum
+        aq = 1.0 / self.angle_quantum
+        ids = array( 'H' )
+        values = array( 'i' )
+        for body, kind, x, y, angle in bodies:
+            body_id = self.ids.get( body )
+            if body_id is None:
+                body_id = self.ids[ body ] = len( self.kinds )
+                self.kinds.append( kind )
+            ids.append( body_id )
+            values.extend( ( int( round( x * pq ) ), int( round( y * pq ) ), int( round( angle * aq ) ) ) )
+
+        deltas = None
+        if self.since_keyframe < self.keyframe_interval and ids == self.prev_ids:
+            try:
+                deltas = array( 'h', [ v - p for v, p in izip( values, self.prev_values ) ] )
+            except OverflowError:
+                deltas = None
+
+        f = self.file
+        if deltas is None:
+            self.keyframe_frames.append( self.n_frames )
+            self.keyframe_offsets.append( f.tell() )
+            f.write( struct.pack( FRAME, KEYFRAME, len(ids) ) )
+            f.write( _to_string( ids ) )
+            f.write( _to_string( values ) )
+            self.since_keyframe = 1
+        else:
+            f.write( struct.pack( FRAME, DELTA, len(ids) ) )
+            f.write( _to_string( deltas ) )
+            self.since_keyframe += 1
+
+        self.prev_ids = ids
+        self.prev_values = values
+        self.n_frames += 1
+
+    def flush( self ):
+        '''Writes the index and the header: the file is a valid trace of the
+        frames added so far. The next frames overwrite the index.'''
+        if not self.file:
+            return
+        f = self.file
+        index_offset = f.tell()
+        f.write( _to_string( self.keyframe_frames ) )
+        f.write( _to_string( self.keyframe_offsets ) )
+        f.write( _to_string( self.kinds ) )
+        f.truncate()
+
+        f.seek( 0 )
+        f.write( struct.pack( HEADER, MAGIC, VERSION, self.keyframe_interval,
+                self.position_quantum, self.angle_quantum, self.first_step or 0,
+                self.n_frames, len( self.kinds ), len( self.keyframe_frames ), index_offset ) )
+        f.flush()
+        f.seek( index_offset )
+
+    def close( self ):
+        if not self.file:
+            return
+        self.flush()
+        self.file.close()
+        self.file = None
+
+class TraceReader( object ):
+
+    def __init__( self, path ):
+        self.file = open( path, 'rb' )
+        self.data = mmap.mmap( self.file.fileno(), 0, access=mmap.ACCESS_READ )
+
+        ( magic, version, self.keyframe_interval, self.position_quantum, self.angle_quantum,
+          self.first_step, self.n_frames, n_ids, n_keyframes, index_offset ) = struct.unpack_from( HEADER, self.data, 0 )
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError( '%s is not a body trace' % path )
+
+        data = self.data
+        offset = index_offset
+        self.keyframe_frames = _from_string( 'I', data[ offset : offset + 4 * n_keyframes ] )
+        offset += 4 * n_keyframes
+        self.keyframe_offsets = _from_string( 'I', data[ offset : offset + 4 * n_keyframes ] )
+        offset += 4 * n_keyframes
+        self.kinds = _from_string( 'b', data[ offset : offset + n_ids ] )
+
+        # last decoded frame: frame number, file offset of the next one, ids, values
+        self.current = None
+
+    def __len__( self ):
+        return self.n_frames
+
+    def close( self ):
+        self.data.close()
+        self.file.close()
+
+    def decode( self, offset, ids, values ):
+        '''decodes the frame at offset, following (ids, values).
+        Returns the offset of the next frame, the ids and the values'''
+        data = self.data
+        tag, n = struct.unpack_from( FRAME, data, offset )
+        offset += FRAME_SIZE
+        if tag == KEYFRAME:
+            ids = _from_string( 'H', data[ offset : offset + 2 * n ] )
+            offset += 2 * n
+            values = _from_string( 'i', data[ offset : offset + 12 * n ] )
+            offset += 12 * n
+        else:
+            deltas = _from_string( 'h', data[ offset : offset + 6 * n ] )
+            offset += 6 * n
+            values = array( 'i', [ v + d for v, d in izip( values, deltas ) ] )
+        return offset, ids, values
+
+    def quantized( self, frame ):
+        '''ids and quantized values of the frame'''
+        if not 0 <= frame < self.n_frames:
+            raise IndexError( 'trace frame %d out of range' % frame )
+
+        k = bisect_right( self.keyframe_frames, frame ) - 1
+        keyframe = self.keyframe_frames[ k ]
+
+        current = self.current
+        if current and keyframe <= current[0] <= frame:
+            # keep decoding from the last frame (sequential playback)
+            n, offset, ids, values = current
+        else:
+            offset, ids, values = self.decode( self.keyframe_offsets[ k ], None, None )
+            n = keyframe
+
+        while n < frame:
+            offset, ids, values = self.decode( offset, ids, values )
+            n += 1
+
+        self.current = ( n, offset, ids, values )
+        return ids, values
+
+    def frame( self, frame ):
+        '''[ (id, x, y, angle) ] of the frame'''
+        ids, values = self.quantized( frame )
+        pq = self.position_quantum
+        aq = self.angle_quantum
+        return [ ( body_id, values[i*3] * pq, values[i*3+1] * pq, values[i*3+2] * aq ) for i, body_id in enumerate( ids ) ]
+
+    def step( self, step ):
+        '''[ (id, x, y, angle) ] after the physics step `step`'''
+        return self.frame( step - self.first_step )
@@ -145,6 +145,48 @@ class grText(pyglet.graphics.Group):
         gl.glPopMatrix()
         gl.glMatrixMode(gl.GL_MODELVIEW)
 
+class fwRetainedPrimitives(object):
+    """
+    Vertices of one primitive type (GL_TRIANGLES, GL_LINES or GL_POINTS)
+    collected during a frame, and drawn with a single call.
+
+    The vertex list is kept between frames, and its data is overwritten
+    in place. It is only resized when the vertex count changes.
+    """
+    def __init__(self, mode):
+        self.mode = mode
+        self.vertices = []  # x,y,x,y...
+        self.colors = []    # r,g,b,a,r,g,b,a...
+        self.vertex_list = None
+
+    def add(self, vertices, colors):
+        self.vertices.extend(vertices)
+        self.colors.extend(colors)
+
+    def draw(self, clear=True):
+        count = len(self.vertices) / 2
+        if count:
+            if not self.vertex_list:
+                self.vertex_list = pyglet.graphics.vertex_list(count, 'v2f/dynamic', 'c4f/dynamic')
+            elif self.vertex_list.get_size() != count:
+                self.vertex_list.resize(count)
+            self.vertex_list.vertices = self.vertices
+            self.vertex_list.colors = self.colors
+            self.vertex_list.draw(self.mode)
+
+        # ready for the next frame
+        if clear:
+            self.clear()
+
+    def clear(self):
+        self.vertices = []
+        self.colors = []
+
+    def delete(self):
+        if self.vertex_list:
+            self.vertex_list.delete()
+            self.vertex_list = None
+
 class fwDebugDraw(box2d.b2DebugDraw):
     """
     This debug draw class accepts callbacks from Box2D (which specifies what to draw)
@@ -157,42 +199,83 @@ class fwDebugDraw(box2d.b2DebugDraw):
     blended = None
     circle_segments = 16
     surface = None
-    circle_cache_tf = {} # triangle fan (inside)
-    circle_cache_ll = {} # line loop (border)
+    circle_cache_tf = {} # points -> unit circle triangle fan (inside), as (xs, ys)
+    circle_cache_ll = {} # points -> unit circle line loop (border), as (xs, ys)
     def __init__(self, p2m_ratio=1):
         super(fwDebugDraw, self).__init__()
 
-        self.batch = None
         self.p2m_ratio = p2m_ratio
+        self.point_size = 1.0
+
+        # one draw call per primitive type
+        self.triangles = fwRetainedPrimitives(gl.GL_TRIANGLES)
+        self.lines = fwRetainedPrimitives(gl.GL_LINES)
+        self.points = fwRetainedPrimitives(gl.GL_POINTS)
+
+    def draw(self, clear=True):
+        """
+        Draws everything the callbacks received since the last clear.
+        With clear=False it is kept, to be drawn again the next frame.
+        """
+        if self.blended:
+            self.blended.set_state()
+        self.triangles.draw(clear)
+        if self.blended:
+            self.blended.unset_state()
+
+        self.lines.draw(clear)
+
+        gl.glPointSize(self.point_size)
+        self.points.draw(clear)
+        gl.glPointSize(1.0)
+
+    def clear(self):
+        """
+        Forgets what the callbacks sent.
+        """
+        self.triangles.clear()
+        self.lines.clear()
+        self.points.clear()
+
+    def delete(self):
+        """
+        Frees the vertex lists.
+        """
+        self.triangles.delete()
+        self.lines.delete()
+        self.points.delete()
 
     def triangle_fan(self, vertices):
         """
         in: vertices arranged for gl_triangle_fan ((x,y),(x,y)...)
         out: vertices arranged for gl_triangles (x,y,x,y,x,y...)
         """
-        out = []
-        for i in range(1, len(vertices)-1):
-            # 0,1,2   0,2,3  0,3,4 ..
-            out.extend( vertices[0  ] )
-            out.extend( vertices[i  ] )
-            out.extend( vertices[i+1] )
-        return len(out) / 2, out
+        # 0,1,2   0,2,3  0,3,4 ..
+        xs, ys = zip(*vertices)
+        n = len(vertices) - 2
+        out = [0.0] * (6 * n)
+        out[0::6] = xs[0:1] * n
+        out[1::6] = ys[0:1] * n
+        out[2::6] = xs[1:-1]
+        out[3::6] = ys[1:-1]
+        out[4::6] = xs[2:]
+        out[5::6] = ys[2:]
+        return 3 * n, out
 
     def line_loop(self, vertices):
         """
         in: vertices arranged for gl_line_loop ((x,y),(x,y)...)
         out: vertices arranged for gl_lines (x,y,x,y,x,y...)
         """
-        out = []
-        for i in range(0, len(vertices)-1):
-            # 0,1  1,2  2,3 ... len-1,len  len,0
-            out.extend( vertices[i  ] )
-            out.extend( vertices[i+1] )
-        
-        out.extend( vertices[len(vertices)-1] )
-        out.extend( vertices[0] )
-
-        return len(out)/2, out
+        # 0,1  1,2  2,3 ... len-1,len  len,0
+        xs, ys = zip(*vertices)
+        n = len(vertices)
+        out = [0.0] * (4 * n)
+        out[0::4] = xs
+        out[1::4] = ys
+        out[2::4] = xs[1:] + xs[:1]
+        out[3::4] = ys[1:] + ys[:1]
+        return 2 * n, out
 
     def _getLLCircleVertices(self, radius, points):
         """
@@ -242,34 +325,42 @@ class fwDebugDraw(box2d.b2DebugDraw):
             ret.append( (math.cos(n) * radius, math.sin(n) * radius ) )
         return ret
 
+    def _unitCircle(self, cache, func, points):
+        """
+        Returns the (xs, ys) of the vertices of the unit circle generated
+        by func, computed once per point count.
+        """
+        if points not in cache:
+            vertices = func(1.0, points)
+            cache[points] = ([x for x, y in vertices], [y for x, y in vertices])
+        return cache[points]
+
+    def _placeCircle(self, unit, center, radius):
+        """
+        Scales and translates the unit circle vertices.
+        Returns (x1, y1, x2, y2, ...)
+        """
+        xs, ys = unit
+        cx, cy = center.x, center.y
+        out = [0.0] * (2 * len(xs))
+        out[0::2] = [x * radius + cx for x in xs]
+        out[1::2] = [y * radius + cy for y in ys]
+        return out
+
     def getCircleVertices(self, center, radius, points):
         """
         Returns the triangles that approximate the circle and
         the lines that border the circles edges, given
         (center, radius, points).
 
-        Caches the calculated LL/TF vertices, but recalculates
-        based on the center passed in.
-
-        TODO: As of this point, there's only one point amount,
-        so the circle cache ignores it when storing. Could cause 
-        some confusion if you're using multiple point counts as
-        only the first stored point-count for that radius will
-        show up.
+        Caches the LL/TF vertices of the unit circle for each point
+        count, and scales and translates them to the circle passed in.
 
         Returns: (tf_vertices, ll_vertices)
         """
-        if radius not in self.circle_cache_tf.keys():
-            self.circle_cache_tf[radius]=self._getTFCircleVertices(radius,points)
-            self.circle_cache_ll[radius]=self._getLLCircleVertices(radius,points)
-
-        ret_tf, ret_ll = [], []
-
-        for x, y in self.circle_cache_tf[radius]:
-            ret_tf.extend( (x+center.x, y+center.y) )
-        for x, y in self.circle_cache_ll[radius]:
-            ret_ll.extend( (x+center.x, y+center.y) )
-        return ret_tf, ret_ll
+        unit_tf = self._unitCircle(self.circle_cache_tf, self._getTFCircleVertices, points)
+        unit_ll = self._unitCircle(self.circle_cache_ll, self._getLLCircleVertices, points)
+        return self._placeCircle(unit_tf, center, radius), self._placeCircle(unit_ll, center, radius)
 
     def DrawCircle(self, center, radius, color):
         """
@@ -280,9 +371,7 @@ class fwDebugDraw(box2d.b2DebugDraw):
         unused, ll_vertices = self.getCircleVertices( center, radius, self.circle_segments)
         ll_count = len(ll_vertices)/2
 
-        self.batch.add(ll_count, gl.GL_LINES, None,
-            ('v2f', ll_vertices),
-            ('c4f', [color.r, color.g, color.b, 1.0] * (ll_count)))
+        self.lines.add(ll_vertices, [color.r, color.g, color.b, 1.0] * (ll_count))
 
     def DrawSolidCircle(self, center, radius, axis, color):
         """
@@ -293,18 +382,12 @@ class fwDebugDraw(box2d.b2DebugDraw):
         tf_vertices, ll_vertices = self.getCircleVertices( center, radius, self.circle_segments)
         tf_count, ll_count = len(tf_vertices) / 2, len(ll_vertices) / 2
 
-        self.batch.add(tf_count, gl.GL_TRIANGLES, self.blended,
-            ('v2f', tf_vertices),
-            ('c4f', [0.5 * color.r, 0.5 * color.g, 0.5 * color.b, 0.5] * (tf_count)))
+        self.triangles.add(tf_vertices, [0.5 * color.r, 0.5 * color.g, 0.5 * color.b, 0.5] * (tf_count))
 
-        self.batch.add(ll_count, gl.GL_LINES, None,
-            ('v2f', ll_vertices),
-            ('c4f', [color.r, color.g, color.b, 1.0] * (ll_count)))
+        self.lines.add(ll_vertices, [color.r, color.g, color.b, 1.0] * (ll_count))
 
         p = center + radius * axis
-        self.batch.add(2, gl.GL_LINES, None,
-            ('v2f', (center.x, center.y, p.x, p.y)),
-            ('c3f', [1.0, 0.0, 0.0] * 2))
+        self.lines.add((center.x, center.y, p.x, p.y), [1.0, 0.0, 0.0, 1.0] * 2)
 
     def DrawPolygon(self, vertices, vertexCount, color):
         """
@@ -318,9 +401,7 @@ class fwDebugDraw(box2d.b2DebugDraw):
 
         ll_count, ll_vertices = self.line_loop(vertices)
 
-        self.batch.add(ll_count, gl.GL_LINES, None,
-            ('v2f', ll_vertices),
-            ('c4f', [color.r, color.g, color.b, 1.0] * (ll_count)))
+        self.lines.add(ll_vertices, [color.r, color.g, color.b, 1.0] * (ll_count))
 
     def DrawSolidPolygon(self, vertices, vertexCount, color):
         """
@@ -333,15 +414,11 @@ class fwDebugDraw(box2d.b2DebugDraw):
         vertices = new_vertices
         tf_count, tf_vertices = self.triangle_fan(vertices)
 
-        self.batch.add(tf_count, gl.GL_TRIANGLES, self.blended,
-            ('v2f', tf_vertices),
-            ('c4f', [0.5 * color.r, 0.5 * color.g, 0.5 * color.b, 0.5] * (tf_count)))
+        self.triangles.add(tf_vertices, [0.5 * color.r, 0.5 * color.g, 0.5 * color.b, 0.5] * (tf_count))
 
         ll_count, ll_vertices = self.line_loop(vertices)
 
-        self.batch.add(ll_count, gl.GL_LINES, None,
-            ('v2f', ll_vertices),
-            ('c4f', [color.r, color.g, color.b, 1.0] * (ll_count)))
+        self.lines.add(ll_vertices, [color.r, color.g, color.b, 1.0] * (ll_count))
 
     def DrawSegment(self, p1, p2, color):
         """
@@ -351,9 +428,7 @@ class fwDebugDraw(box2d.b2DebugDraw):
         p1.y *= self.p2m_ratio
         p2.x *= self.p2m_ratio
         p2.y *= self.p2m_ratio
-        self.batch.add(2, gl.GL_LINES, None,
-            ('v2f', (p1.x, p1.y, p2.x, p2.y)),
-            ('c3f', [color.r, color.g, color.b]*2))
+        self.lines.add((p1.x, p1.y, p2.x, p2.y), [color.r, color.g, color.b, 1.0]*2)
 
     def DrawXForm(self, xf):
         """
@@ -365,9 +440,8 @@ class fwDebugDraw(box2d.b2DebugDraw):
         p2 = p1 + k_axisScale * xf.R.col1
         p3 = p1 + k_axisScale * xf.R.col2
 
-        self.batch.add(3, gl.GL_LINES, None,
-            ('v2f', (p1.x, p1.y, p2.x, p2.y, p1.x, p1.y, p3.x, p3.y)),
-            ('c3f', [1.0, 0.0, 0.0] * 2 + [0.0, 1.0, 0.0] * 2))
+        self.lines.add((p1.x, p1.y, p2.x, p2.y, p1.x, p1.y, p3.x, p3.y),
+            [1.0, 0.0, 0.0, 1.0] * 2 + [0.0, 1.0, 0.0, 1.0] * 2)
 
     def DrawPoint(self, p, size, color):
         """
@@ -375,18 +449,101 @@ class fwDebugDraw(box2d.b2DebugDraw):
         """
         p.x *= self.p2m_ratio
         p.y *= self.p2m_ratio
-        self.batch.add(1, gl.GL_POINTS, grPointSize(size),
-            ('v2f', (p.x, p.y)),
-            ('c3f', [color.r, color.g, color.b]))
+        # all the points of a frame are drawn with the same size
+        self.point_size = size
+        self.points.add((p.x, p.y), [color.r, color.g, color.b, 1.0])
         
     def DrawAABB(self, aabb, color):
         """
         Draw a wireframe around the AABB with the given color.
         """
         print 'DrawAABB without ratio'
-        self.debugDraw.batch.add(8, gl.GL_LINES, None,
-            ('v2f', (aabb.lowerBound.x, aabb.lowerBound.y, abb.upperBound.x, aabb.lowerBound.y, 
-                abb.upperBound.x, aabb.lowerBound.y, aabb.upperBound.x, aabb.upperBound.y,
+        self.lines.add((aabb.lowerBound.x, aabb.lowerBound.y, aabb.upperBound.x, aabb.lowerBound.y, 
+                aabb.upperBound.x, aabb.lowerBound.y, aabb.upperBound.x, aabb.upperBound.y,
                 aabb.upperBound.x, aabb.upperBound.y, aabb.lowerBound.x, aabb.upperBound.y,
-                aabb.lowerBound.x, aabb.upperBound.y, aabb.lowerBound.x, aabb.lowerBound.y)),
-            ('c3f', [color.r, color.g, color.b] * 8))
+                aabb.lowerBound.x, aabb.upperBound.y, aabb.lowerBound.x, aabb.lowerBound.y),
+            [color.r, color.g, color.b, 1.0] * 8)
+
+# the colors used by b2World::DrawDebugData
+color_static = box2d.b2Color(0.5, 0.9, 0.5)
+color_sleeping = box2d.b2Color(0.5, 0.5, 0.9)
+color_dynamic = box2d.b2Color(0.9, 0.9, 0.9)
+
+def drawBodyShapes(debugDraw, body, color):
+    """
+    Sends the shapes of body to debugDraw, the same way
+    b2World::DrawShape does.
+    """
+    for shape in body.shapeList:
+        type = shape.GetType()
+        if type == box2d.e_circleShape:
+            circle = shape.asCircle()
+            center = body.GetWorldPoint(circle.GetLocalPosition())
+            axis = body.GetWorldVector((1.0, 0.0))
+            debugDraw.DrawSolidCircle(center, circle.radius, axis, color)
+        elif type == box2d.e_polygonShape:
+            vertices = [body.GetWorldPoint(v) for v in shape.asPolygon().getVertices_tuple()]
+            debugDraw.DrawSolidPolygon([(v.x, v.y) for v in vertices], len(vertices), color)
+
+def drawStaticBodies(debugDraw, world):
+    """
+    Sends the shapes of the static bodies of world to debugDraw.
+    """
+    for body in world.bodyList:
+        if body.IsStatic():
+            drawBodyShapes(debugDraw, body, color_static)
+
+def drawDynamicBodies(debugDraw, world):
+    """
+    Sends the shapes of the non static bodies of world to debugDraw.
+    """
+    for body in world.bodyList:
+        if body.IsStatic():
+            continue
+        if body.IsSleeping():
+            color = color_sleeping
+        else:
+            color = color_dynamic
+        drawBodyShapes(debugDraw, body, color)
+
+class fwStaticGeometry(object):
+    """
+    The shapes of the static bodies of the world, baked once into
+    a display list and drawn with a single glCallList.
+
+    Static bodies don't move, so the display list is valid until
+    one of them is destroyed. Call invalidate() then, and the
+    geometry will be baked again on the next draw.
+    """
+    def __init__(self, p2m_ratio=1):
+        self.p2m_ratio = p2m_ratio
+        self.display_list = None
+
+    def build(self, world):
+        """
+        Bakes the shapes of the static bodies of world.
+        """
+        self.delete()
+
+        debugDraw = fwDebugDraw(self.p2m_ratio)
+        drawStaticBodies(debugDraw, world)
+
+        # the display list keeps a copy of the vertex data
+        self.display_list = gl.glGenLists(1)
+        gl.glNewList(self.display_list, gl.GL_COMPILE)
+        debugDraw.draw()
+        gl.glEndList()
+        debugDraw.delete()
+
+    def draw(self, world):
+        if not self.display_list:
+            self.build(world)
+        gl.glCallList(self.display_list)
+
+    def invalidate(self):
+        self.delete()
+
+    def delete(self):
+        if self.display_list:
+            gl.glDeleteLists(self.display_list, 1)
+            self.display_list = None
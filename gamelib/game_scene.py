@@ -1,9 +1,9 @@
 # std lib
 import math
+import os
 import random
 
 # pyglet
-import pyglet
 from pyglet.gl import *
 from pyglet.window.key import *
 
@@ -27,27 +27,36 @@ import levels
 import soundex
 import data
 import svg_box2d_parser
+import level_prefetch
 import HUD
 import gameover
 from box2d_callbacks import *
 from settings import fwSettings
 import gradient_layer
+import input_replay
+import body_trace
 
 PTM_RATIO = 52
 TORQUE_FORCE = 15
 JUMP_IMPULSE = 8
 
+# body categories, used to dispatch the collisions
+KIND_GASMAN, KIND_GASWOMAN, KIND_FOOD, KIND_BAD_GUY, KIND_DEADLY = range(5)
+
 class GameLayer(cocos.layer.Layer):
 
     is_event_handler = True     #: enable pyglet's events
    
-    def __init__(self):
+    def __init__(self, prefetcher=None):
         super(GameLayer,self).__init__()
 
+        # prefetcher of the next level
+        self.prefetcher = None
+
         self.schedule( self.main_loop)
         self.schedule_interval( self.show_level, 0.5 )
 
-        self.init_background()
+        self.init_background( prefetcher )
         self.init_game_state()
         self.init_events()
         self.init_sounds()
@@ -60,17 +69,19 @@ class GameLayer(cocos.layer.Layer):
         self.unschedule( self.show_level )
         self.HUD_delegate.show_level_name()
         self.state.state = state.STATE_PLAY
+        self.record_input( 'play' )
 
     #
     # IMAGES
     #
-    def init_background( self ):
+    def init_background( self, prefetcher=None ):
         self.with_background = True
-        name = levels.get_level_filename( state.level_idx )
-        name = name.split('.')[0]
-        name = '%s.png' % name
+        name = levels.get_level_background( state.level_idx )
         try:
-            background = Sprite( name )
+            if prefetcher and prefetcher.background:
+                background = Sprite( prefetcher.background )
+            else:
+                background = Sprite( name )
             background.image_anchor = (0,0)
             self.add( background )
         except Exception:
@@ -125,31 +136,38 @@ class GameLayer(cocos.layer.Layer):
     def init_sprites( self ):
 
         sprite = sqa.SVG_CacheNode()
-        node= sqa.SVGnode( data.filepath("sprites/gasman-character.svg") )
+        node= sqa.SVGnode( data.filepath("sprites/gasman-character.svg"), lod=True, raster=fwSettings.rasterSprites )
         sprite.add(node)
         self.add( sprite)
         self.gasman_sprite = sprite
 
         sprite = sqa.SVG_CacheNode()
-        node= sqa.SVGnode( data.filepath("sprites/gaswoman-character.svg") )
+        node= sqa.SVGnode( data.filepath("sprites/gaswoman-character.svg"), lod=True, raster=fwSettings.rasterSprites )
         sprite.add(node)
         self.add( sprite)
         self.gaswoman_sprite = sprite
 
+        # all the bad guys are drawn by one batch node
+        self.badguys_batch = sqa.SVG_BatchNode()
+        self.add( self.badguys_batch )
+
     #
     # PHYSICS
     #
     def init_physics( self ):
         self.points             = []
         self.destroyList        = []
-        self.food_places        = []
-        self.bad_guys           = []
-        self.deadly_places      = []
+        self.body_kinds         = {}    # body -> KIND_xxx
+        self.sprite_bodies      = {}    # body -> [sprite, synced state, at rest]
+        self.sprite_updates     = 0     # sprites updated in the last frame
+        self.sprite_updates_skipped = 0 # sprites not updated in the last frame
+        self.accumulator        = 0.0
+        self.previous_states    = {}
+        self.step_count         = 0     # physics steps done
         settings = fwSettings
 
         # Box2D Initialization
 
-        win_size = director.get_window_size()
         self.worldAABB = box2d.b2AABB()
         self.worldAABB.lowerBound = (-30,-30)
         self.worldAABB.upperBound = (45,41)
@@ -161,8 +179,6 @@ class GameLayer(cocos.layer.Layer):
         self.destructionListener = fwDestructionListener()
         self.boundaryListener = fwBoundaryListener()
         self.contactListener = fwContactListener()
-        self.debugDraw = fwDebugDraw(PTM_RATIO)          # 1 meter == 10 pixels
-        self.debugDraw.batch = pyglet.graphics.Batch()
     
         self.destructionListener.test = self
         self.boundaryListener.test = self
@@ -176,8 +192,33 @@ class GameLayer(cocos.layer.Layer):
         self.world.SetWarmStarting(settings.enableWarmStarting)
         self.world.SetContinuousPhysics(settings.enableTOI)
 
+        # (kind, kind) -> handler. The kinds must be sorted.
+        self.collision_handlers = {
+            (KIND_GASMAN, KIND_FOOD):       self.food_eat,
+            (KIND_GASMAN, KIND_GASWOMAN):   self.collision_gasman_gaswoman,
+            (KIND_GASMAN, KIND_DEADLY):     self.collision_gasman_deadly,
+            (KIND_GASMAN, KIND_BAD_GUY):    self.collision_gasman_badguy,
+            }
+
+        self.init_debug_draw()
+
+        self.setup_physics_world()
+
+    def init_debug_draw( self ):
+        settings = fwSettings
+
+        self.debugDraw = fwDebugDraw(PTM_RATIO)          # 1 meter == 10 pixels
+        self.debugDrawInStep = False
+        self.staticGeometry = None
+
         if not self.with_background:
-            self.world.SetDebugDraw( self.debugDraw )
+            if settings.bakeStaticGeometry:
+                # static bodies are baked once, dynamic bodies are sent every frame in draw()
+                self.staticGeometry = fwStaticGeometry(PTM_RATIO)
+            else:
+                # world.Step() sends what the flags ask for
+                self.world.SetDebugDraw( self.debugDraw )
+                self.debugDrawInStep = True
 
         # Set the flags based on what the settings show (uses a bitwise or mask)
         flags = 0
@@ -191,8 +232,6 @@ class GameLayer(cocos.layer.Layer):
         if settings.drawCOMs:       flags |= box2d.b2DebugDraw.e_centerOfMassBit
         self.debugDraw.SetFlags(flags)
 
-        self.setup_physics_world()
-
     # 
     # physics callbacks
     #
@@ -213,7 +252,7 @@ class GameLayer(cocos.layer.Layer):
             key,value = keypair.split('=')
             if key=='sprite':
                 if value=='food':
-                    self.food_places.append( body )
+                    self.body_kinds[ body ] = KIND_FOOD
                     shape = body.shapeList[0]
                     body.DestroyShape(shape)
                     sd = box2d.b2CircleDef()
@@ -221,12 +260,12 @@ class GameLayer(cocos.layer.Layer):
                     sd.isSensor = True
                     body.CreateShape(sd)
                     body.SetMassFromShapes()
-                    sprite = Sprite('sprites/bean-man.png')
+                    sprite = self.create_food_sprite()
                     self.add( sprite )
-                    body.userData = sprite
+                    self.register_sprite( body, sprite )
 
                 elif value=='bad_guy':
-                    self.bad_guys.append( body )
+                    self.body_kinds[ body ] = KIND_BAD_GUY
                     shape = body.shapeList[0]
                     sd = box2d.b2CircleDef()
                     sd.radius = 0.5
@@ -237,15 +276,13 @@ class GameLayer(cocos.layer.Layer):
                     body.CreateShape(sd)
                     body.SetMassFromShapes()
 
-                    sprite = sqa.SVG_CacheNode()
-                    node= sqa.SVGnode( data.filepath("sprites/badguy-character.svg") )
-                    sprite.add(node)
-                    self.add( sprite)
-                    body.userData = sprite
+                    node= sqa.SVGnode( data.filepath("sprites/badguy-character.svg"), lod=True, raster=fwSettings.rasterSprites )
+                    self.badguys_batch.add(node)
+                    self.register_sprite( body, node )
 
                 elif value=='gasman':
                     self.gasman_body = body
-                    body.userData = self.gasman_sprite
+                    self.body_kinds[ body ] = KIND_GASMAN
                     shape = body.shapeList[0]
                     body.DestroyShape(shape)
                     sd = box2d.b2CircleDef()
@@ -255,10 +292,11 @@ class GameLayer(cocos.layer.Layer):
                     sd.restitution = 0.2
                     body.CreateShape(sd)
                     body.SetMassFromShapes()
+                    self.register_sprite( body, self.gasman_sprite )
 
                 elif value=='gaswoman':
                     self.gaswoman_body = body
-                    body.userData = self.gaswoman_sprite
+                    self.body_kinds[ body ] = KIND_GASWOMAN
                     shape = body.shapeList[0]
                     sd = box2d.b2CircleDef()
                     sd.radius = 0.5
@@ -270,15 +308,33 @@ class GameLayer(cocos.layer.Layer):
                     body.DestroyShape(shape)
 
                     body.SetMassFromShapes()
+                    self.register_sprite( body, self.gaswoman_sprite )
 
                 elif value=='game_over':
-                    self.deadly_places.append( body )
+                    self.body_kinds[ body ] = KIND_DEADLY
+
+
+    def register_sprite( self, body, sprite ):
+        # the sprite will follow the body. The shape won't change, so the scale neither
+        body.userData = sprite
+        shape = body.shapeList[0]
+        sprite.scale = ( shape.radius * 2)     # scale 1 == 1 meter
 
+        # sprite, last synced state, at rest
+        self.sprite_bodies[ body ] = [ sprite, None, False ]
+
+    def unregister_sprite( self, body ):
+        if body in self.sprite_bodies:
+            del self.sprite_bodies[ body ]
+
+    def create_food_sprite( self ):
+        return Sprite('sprites/bean-man.png')
 
     def setup_physics_world( self ):
 
         level_name = levels.get_level_filename( self.state.level_idx )
-        parser = svg_box2d_parser.SVGBox2dParser( self.world, level_name, ratio=PTM_RATIO, callback=self.physics_game_cb)
+        parser_class = svg_box2d_parser.parsers[ fwSettings.levelParser ]
+        parser = parser_class( self.world, level_name, ratio=PTM_RATIO, callback=self.physics_game_cb)
         parser.parse()
 
         # create Gas Man
@@ -309,12 +365,56 @@ class GameLayer(cocos.layer.Layer):
 #            sd.restitution = 0.00001
 #            body.CreateShape(sd)
 #            body.SetMassFromShapes()
-#            self.food_places.append( body )
+#            self.body_kinds[ body ] = KIND_FOOD
 
     #
     # MAIN LOOP
     #
     def main_loop(self, dt):
+        settings = fwSettings
+
+        # Prepare for simulation. Typically we use a time step of 1/60 of a
+        # second (60Hz) and 10 velocity/8 position iterations. This provides a 
+        # high quality simulation in most game scenarios.
+        timeStep = 1.0 / settings.hz
+
+        if not settings.fixedTimestep:
+            self.physics_step( timeStep )
+            self.update_sprite_positions()
+            return
+
+        # It is generally best to keep the time step and iterations fixed.
+        # So consume the elapsed time in fixed steps, and keep the remainder
+        # for the next frame
+        self.accumulator += dt
+        steps = 0
+        in_scene = self.is_running
+        while self.accumulator >= timeStep and steps < settings.maxSubSteps:
+            playing = self.state.state == state.STATE_PLAY
+            self.save_previous_states()
+            self.physics_step( timeStep )
+            self.accumulator -= timeStep
+            steps += 1
+
+            # the step ended the level (won, lost, or this layer was
+            # replaced): don't simulate the rest of the backlog
+            if (playing and self.state.state != state.STATE_PLAY) or (in_scene and not self.is_running):
+                break
+
+        # too slow to catch up: drop the backlog instead of spiraling
+        if self.accumulator >= timeStep:
+            self.accumulator %= timeStep
+
+        #
+        # update sprites based on physics bodies / shapes
+        #
+        self.update_sprite_positions( self.accumulator / timeStep )
+
+    def physics_step( self, timeStep ):
+        if self.input_player:
+            self.input_player.apply( self, self.step_count )
+        self.step_count += 1
+
         #
         # check collision detection
         #
@@ -325,58 +425,60 @@ class GameLayer(cocos.layer.Layer):
         #
         # Physics main loop
         #
-        # Prepare for simulation. Typically we use a time step of 1/60 of a
-        # second (60Hz) and 10 velocity/8 position iterations. This provides a 
-        # high quality simulation in most game scenarios.
-#        timeStep = dt
-        timeStep = 1.0 / 60
-        vel_iters, pos_iters = 10, 8
-
-        # It is generally best to keep the time step and iterations fixed.
+        vel_iters, pos_iters = fwSettings.velocityIterations, fwSettings.positionIterations
+        if self.debugDrawInStep:
+            # only the last step of the frame is drawn
+            self.debugDraw.clear()
         self.world.Step(timeStep, vel_iters, pos_iters)
-        self.world.Validate()
+        if fwSettings.validateWorld:
+            self.world.Validate()
 
         #
         # cleanup
         #
         # Destroy bodies that have left the world AABB (can be removed if not using pickling)
         for obj in self.destroyList:
+            self.unregister_sprite( obj )
+            if self.staticGeometry and obj.IsStatic():
+                self.staticGeometry.invalidate()
             self.world.DestroyBody(obj)
         self.destroyList = []
 
-        #
-        # update sprites based on physics bodies / shapes
-        #
-        self.update_sprite_positions()
+        if self.trace:
+            self.trace.add( self.step_count, self.trace_bodies() )
 
     def check_collision_detection( self ):
 
-        # Traverse the contact results. Destroy bodies that
-        # are touching heavier bodies.
-        body_pairs = [(p.shape1.GetBody(), p.shape2.GetBody()) for p in self.points]
-        
-        for pair in body_pairs:
-            body1 = pair[0]
-            body2 = pair[1]
-            if ( (body1 in self.food_places or body2 in self.food_places) and \
-                (body1 == self.gasman_body or body2 == self.gasman_body ) ):
-                    self.food_eat( body1, body2 )
-            elif ( self.gasman_body in pair and self.gaswoman_body in pair):
-                self.collision_gasman_gaswoman()
-            elif ( self.gasman_body in pair and (body1 in self.deadly_places or body2 in self.deadly_places ) ):
-                self.collision_gasman_deadly()
-            elif ( self.gasman_body in pair and (body1 in self.bad_guys or body2 in self.bad_guys ) ):
-                self.collision_gasman_badguy()
-
-    def collision_gasman_gaswoman( self ):
+        # Traverse the contact results, and dispatch them by the
+        # kind of the bodies. Each pair is handled once per step.
+        kinds = self.body_kinds
+        handled = set()
+        for p in self.points:
+            body1 = p.shape1.GetBody()
+            body2 = p.shape2.GetBody()
+            kind1 = kinds.get( body1 )
+            kind2 = kinds.get( body2 )
+            if kind1 is None or kind2 is None:
+                continue
+            if kind2 < kind1:
+                body1, body2 = body2, body1
+                kind1, kind2 = kind2, kind1
+
+            handler = self.collision_handlers.get( (kind1, kind2) )
+            if handler and (body1, body2) not in handled:
+                handled.add( (body1, body2) )
+                handler( body1, body2 )
+
+    def collision_gasman_gaswoman( self, gasman, gaswoman ):
         if self.state.state == state.STATE_PLAY:
             self.state.state = state.STATE_WIN
             self.state.score += 10
             self.sounds_level_complete.play()
             self.HUD_delegate.level_complete()
             self.schedule_interval( self.level_next_async, 1.5 )
+            self.prefetch_next_level()
 
-    def collision_gasman_deadly( self ):
+    def collision_gasman_deadly( self, gasman, deadly ):
         if self.state.state == state.STATE_PLAY:
             self.sounds_argh.play()
             self.state.lives -= 1
@@ -386,7 +488,7 @@ class GameLayer(cocos.layer.Layer):
             else:
                 self.level_replay()
 
-    def collision_gasman_badguy( self ):
+    def collision_gasman_badguy( self, gasman, bad_guy ):
         if self.state.state == state.STATE_PLAY:
             self.sounds_ouch.play()
             self.state.lives -= 1
@@ -396,17 +498,17 @@ class GameLayer(cocos.layer.Layer):
             else:
                 self.level_replay()
 
-    def food_eat( self, body1, body2 ):
-        shape = self.gasman_body.shapeList[0]
+    def food_eat( self, gasman, food_body ):
+        if self.state.state != state.STATE_PLAY:
+            return
 
-        # destroy food
-        food_body = body1
-        if body2 in self.food_places:
-            food_body = body2
+        shape = gasman.shapeList[0]
 
+        # destroy food
         self.remove( food_body.userData )
+        self.unregister_sprite( food_body )
         self.destroyList.append( food_body )
-        self.food_places.remove( food_body )
+        del self.body_kinds[ food_body ]
 
         self.state.coins += 1
         self.state.score += 3
@@ -432,23 +534,56 @@ class GameLayer(cocos.layer.Layer):
 
                     
 
-    def update_sprite_positions( self ):
-        # position
+    def save_previous_states( self ):
+        # state of the bodies before the step. Used to interpolate the sprites
+        self.previous_states = {}
+        for body, entry in self.sprite_bodies.iteritems():
+            if body.IsSleeping() or body.IsStatic():
+                continue
+            position = body.position
+            self.previous_states[ entry[0] ] = (position.x, position.y, body.angle)
+
+    def update_sprite_positions( self, alpha=1.0 ):
+        # alpha: how far (0..1) the render time is between the previous
+        # physics state and the current one
+
+        updated = 0
+        skipped = 0
+        for body, entry in self.sprite_bodies.iteritems():
+            sprite, synced, at_rest = entry
+
+            if body.IsSleeping() or body.IsStatic():
+                # not moving: sync it once with the exact position
+                if at_rest:
+                    skipped += 1
+                    continue
+                entry[2] = True
+                position = body.position
+                x, y, angle = position.x, position.y, body.angle
+            else:
+                entry[2] = False
+                position = body.position
+                x, y, angle = position.x, position.y, body.angle
+                if alpha < 1.0 and sprite in self.previous_states:
+                    prev_x, prev_y, prev_angle = self.previous_states[sprite]
+                    x = prev_x + (x - prev_x) * alpha
+                    y = prev_y + (y - prev_y) * alpha
+                    angle = prev_angle + (angle - prev_angle) * alpha
 
+            if (x, y, angle) == synced:
+                skipped += 1
+                continue
+            entry[1] = (x, y, angle)
+            updated += 1
 
-        for body in self.world.bodyList:
-            sprite = body.userData
-            if isinstance( sprite, cocos.cocosnode.CocosNode):
-                position = body.position
-                position = (position.x * PTM_RATIO, position.y * PTM_RATIO)
-                sprite.position = position
-                shape = body.shapeList[0]
-                sprite.scale = ( shape.radius * 2)     # scale 1 == 1 meter
+            # position
+            sprite.position = (x * PTM_RATIO, y * PTM_RATIO)
 
-                # angle
-                angle = body.angle
-                angle = math.degrees( angle )
-                sprite.rotation = -angle
+            # angle
+            sprite.rotation = -math.degrees( angle )
+
+        self.sprite_updates = updated
+        self.sprite_updates_skipped = skipped
 
     #
     # DRAW
@@ -458,12 +593,22 @@ class GameLayer(cocos.layer.Layer):
 
         glPushMatrix()
         self.transform()
-        self.debugDraw.batch.draw()
+        if self.staticGeometry and fwSettings.drawShapes:
+            self.staticGeometry.draw( self.world )
+            drawDynamicBodies( self.debugDraw, self.world )
+        # what world.Step() sent is kept for the frames without a step
+        self.debugDraw.draw( clear=not self.debugDrawInStep )
 
         glPopMatrix()
 
-        # clean used batch
-        self.debugDraw.batch = pyglet.graphics.Batch()
+    def on_exit( self ):
+        super(GameLayer, self).on_exit()
+        if self.debugDraw:
+            self.debugDraw.delete()
+        if self.staticGeometry:
+            self.staticGeometry.delete()
+        # the layer may be entered again (transitions, pause): keep recording
+        self.save_recordings()
 
     #
     # EVENTS
@@ -471,7 +616,68 @@ class GameLayer(cocos.layer.Layer):
     def init_events( self ):
         self.keys_pressed = set()
 
+        # input recording / replay. See input_replay.py
+        self.recorder = None
+        self.input_player = None
+        # body states of every step. See body_trace.py
+        self.trace = None
+
+        self.recording_name = input_replay.new_name( self.state.level_idx )
+        if fwSettings.recordInput:
+            self.recorder = input_replay.InputRecorder( self.state.level_idx, fwSettings.hz,
+                    fwSettings.velocityIterations, fwSettings.positionIterations )
+        if fwSettings.recordTrace:
+            if not os.path.isdir( fwSettings.recordTrace ):
+                os.makedirs( fwSettings.recordTrace )
+            path = os.path.join( fwSettings.recordTrace, self.recording_name + '.trace' )
+            self.trace = body_trace.TraceWriter( path, fwSettings.traceKeyframes )
+
+    def save_recordings( self ):
+        # writes what was recorded so far. The layer keeps recording.
+        if self.recorder:
+            path = os.path.join( fwSettings.recordInput, self.recording_name + '.txt' )
+            self.recorder.save( path, self.step_count )
+        if self.trace:
+            self.trace.flush()
+
+    def close_recordings( self ):
+        self.save_recordings()
+        self.recorder = None
+        if self.trace:
+            self.trace.close()
+            self.trace = None
+
+    def trace_bodies( self ):
+        kinds = self.body_kinds
+        return [ (body, kinds.get( body, -1 ), body.position.x, body.position.y, body.angle)
+                    for body in self.world.bodyList if not body.IsStatic() ]
+
+    def record_input( self, command, *args ):
+        if self.recorder:
+            self.recorder.record( self.step_count, command, *args )
+
+    def replay_command( self, command, args ):
+        if command == 'play':
+            self.state.state = state.STATE_PLAY
+        elif command == 'fart':
+            self.fart()
+        elif command == 'keys':
+            self.keys_pressed = set( args )
+            self.update_keys()
+
+    def fart( self ):
+        if self.state.farts > 0 :
+            self.record_input( 'fart' )
+            self.state.farts -= 1
+            body = self.gasman_body
+#            f = (0.0, JUMP_IMPULSE)
+            f = body.GetWorldVector((0.0, JUMP_IMPULSE))
+            p = body.GetWorldPoint((0.0, 0.0))
+            body.ApplyImpulse(f, p)
+            random.choice( self.sounds_farts ).play()
+
     def update_keys(self):
+        self.record_input( 'keys', *sorted( self.keys_pressed ) )
         torque = 0
         for key in self.keys_pressed:
             if key == LEFT:
@@ -485,14 +691,7 @@ class GameLayer(cocos.layer.Layer):
     def on_key_press (self, key, modifiers):
         if self.state.state == state.STATE_PLAY:
             if key == UP or key == SPACE:
-                if self.state.farts > 0 :
-                    self.state.farts -= 1
-                    body = self.gasman_body
-#                f = (0.0, JUMP_IMPULSE)
-                    f = body.GetWorldVector((0.0, JUMP_IMPULSE))
-                    p = body.GetWorldPoint((0.0, 0.0))
-                    body.ApplyImpulse(f, p)
-                    random.choice( self.sounds_farts ).play()
+                self.fart()
                 return True
             elif key in (LEFT, RIGHT):
                 self.keys_pressed.add(key)
@@ -536,10 +735,17 @@ class GameLayer(cocos.layer.Layer):
     # level management
     #
     def level_new( self ):
+        self.close_recordings()
+
+        prefetcher = None
+        if self.prefetcher and self.prefetcher.level_idx == state.level_idx:
+            prefetcher = self.prefetcher
+            prefetcher.finish()
+
         scene = self.parent
         hud = scene.get('hud')
         scene.remove( 'ctrl' )
-        gameModel = GameLayer()
+        gameModel = GameLayer( prefetcher )
         gameModel.HUD_delegate = hud
         scene.add( gameModel, z=1, name='ctrl')
 
@@ -564,6 +770,17 @@ class GameLayer(cocos.layer.Layer):
         self.unschedule( self.level_next_async )
         self.level_next()
 
+    def prefetch_next_level( self ):
+        if state.level_idx < len( levels.levels) -1:
+            parser_class = svg_box2d_parser.parsers[ fwSettings.levelParser ]
+            self.prefetcher = level_prefetch.LevelPrefetcher( state.level_idx + 1, PTM_RATIO, parser_class )
+            self.schedule( self.prefetch_step )
+
+    def prefetch_step( self, dt ):
+        # GL work of the prefetcher: a small slice per frame
+        if self.prefetcher.step():
+            self.unschedule( self.prefetch_step )
+
 def get_game_scene():
     state.reset()
 
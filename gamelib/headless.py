@@ -0,0 +1,175 @@
+'''Headless physics simulation.
+
+Builds the levels with SVGBox2dParser and runs GameLayer.main_loop as fast
+as the CPU allows, without a window or a GL context.
+Useful to benchmark the physics cost of each level on boxes without display.
+
+It also replays the input recorded with --recordInput, timing every step:
+the recorded run is reproduced, so it can be compared between builds.
+
+Usage:
+    python run_game.py --headless [--headlessSteps=3600] [--headlessLevel=0]
+    python run_game.py --replay=inputs/xxx.txt [--replayTimings=steps.txt]
+'''
+
+import time
+
+import cocos
+from cocos.director import director
+
+# locals
+from state import state
+import levels
+import game_scene
+import input_replay
+from settings import fwSettings
+
+__all__ = [ 'SilentGameLayer', 'HeadlessGameLayer', 'simulate', 'replay', 'percentile', 'main', 'replay_main' ]
+
+
+class SilentSound( object ):
+    def play( self ):
+        pass
+
+class HeadlessHUD( object ):
+    def show_level_name( self ):
+        pass
+
+    def level_complete( self ):
+        pass
+
+class SilentGameLayer( game_scene.GameLayer ):
+    '''A GameLayer without sounds, HUD nor level changes: it keeps
+    simulating the same level.'''
+
+    def __init__( self ):
+        self.level_restarts = 0
+        super(SilentGameLayer,self).__init__()
+        self.HUD_delegate = HeadlessHUD()
+
+    def init_sounds( self ):
+        silent = SilentSound()
+        self.sounds_coin = silent
+        self.sounds_powerup = silent
+        self.sounds_farts = [ silent ]
+        self.sounds_level_complete = silent
+        self.sounds_ouch = silent
+        self.sounds_argh = silent
+
+    def prefetch_next_level( self ):
+        pass
+
+    def level_new( self ):
+        # there is no scene to rebuild the level in. Keep simulating.
+        self.level_restarts += 1
+
+class HeadlessGameLayer( SilentGameLayer ):
+    '''A GameLayer that never touches GL nor the sound card.
+
+    Sprites are replaced by plain CocosNodes, so update_sprite_positions
+    still does its work, but nothing is drawn.
+    '''
+
+    def init_background( self, prefetcher=None ):
+        self.with_background = False
+
+    def init_debug_draw( self ):
+        self.debugDraw = None
+        self.debugDrawInStep = False
+        self.staticGeometry = None
+
+    def create_food_sprite( self ):
+        return cocos.cocosnode.CocosNode()
+
+
+def simulate( level_idx, steps ):
+    '''Simulates `steps` physics steps of the level `level_idx`.
+    Returns the elapsed time in seconds.'''
+    state.reset()
+    state.set_level( level_idx )
+
+    layer = HeadlessGameLayer()
+    state.state = state.STATE_PLAY
+    layer.record_input( 'play' )
+
+    dt = 1.0 / fwSettings.hz
+    start = time.time()
+    try:
+        for i in xrange( steps ):
+            layer.main_loop( dt )
+        return time.time() - start
+    finally:
+        # flush the --recordInput / --recordTrace files of the run
+        layer.close_recordings()
+
+def replay( path ):
+    '''Replays the input log `path`.
+    Returns the layer and the elapsed time in seconds of every step.'''
+    log = input_replay.load( path )
+
+    # the run is only reproduced with the recorded physics settings
+    fwSettings.hz = log.hz
+    fwSettings.velocityIterations = log.velocity_iterations
+    fwSettings.positionIterations = log.position_iterations
+
+    state.reset()
+    state.set_level( log.level_idx )
+
+    layer = HeadlessGameLayer()
+    layer.input_player = input_replay.InputPlayer( log )
+
+    dt = 1.0 / fwSettings.hz
+    timings = []
+    for i in xrange( log.steps ):
+        start = time.time()
+        layer.main_loop( dt )
+        timings.append( time.time() - start )
+    return layer, timings
+
+def percentile( values, p ):
+    '''nearest rank percentile (0..100) of the values'''
+    ordered = sorted( values )
+    if not ordered:
+        return 0.0
+    rank = int( round( p / 100.0 * (len(ordered) - 1) ) )
+    return ordered[ rank ]
+
+def init_director():
+    # there is no director.init(), but every CocosNode camera asks the
+    # director for the window size
+    director._window_original_width = 800
+    director._window_original_height = 600
+
+def replay_main():
+    init_director()
+
+    layer, timings = replay( fwSettings.replay )
+    layer.close_recordings()
+    if fwSettings.replayTimings:
+        f = open( fwSettings.replayTimings, 'w' )
+        f.write( ''.join( [ '%.6f\n' % (t * 1000) for t in timings ] ) )
+        f.close()
+
+    ms = [ t * 1000 for t in timings ]
+    print 'level %d (%s): %d steps, %.3f seconds' % ( state.level_idx, levels.get_level_name( state.level_idx ), len(ms), sum(timings) )
+    if ms:
+        print 'ms/step: mean %.3f  p50 %.3f  p95 %.3f  p99 %.3f  max %.3f' % ( sum(ms) / len(ms),
+                percentile( ms, 50 ), percentile( ms, 95 ), percentile( ms, 99 ), max(ms) )
+    # compare these between two replays to check the run was reproduced
+    position = layer.gasman_body.position
+    print 'gas man at (%.4f, %.4f), score %d, coins %d, farts %d' % ( position.x, position.y,
+            state.score, state.coins, state.farts )
+
+def main():
+    init_director()
+
+    if fwSettings.headlessLevel >= 0:
+        idxs = [ fwSettings.headlessLevel ]
+    else:
+        idxs = range( len(levels.levels) )
+
+    steps = fwSettings.headlessSteps
+    print '%-4s %-24s %8s %10s %12s' % ('idx', 'level', 'steps', 'seconds', 'steps/sec')
+    for idx in idxs:
+        elapsed = simulate( idx, steps )
+        print '%-4d %-24s %8d %10.3f %12.1f' % ( idx, levels.get_level_name(idx), steps, elapsed, steps / max(elapsed, 1e-9) )
@@ -0,0 +1,121 @@
+'''Input recording and replay.
+
+The GameLayer inputs that change the simulation are logged with the index
+of the physics step that follows them. Feeding them back before the same
+steps of a fixed step simulation reproduces the level run, so recorded
+sessions can be replayed as benchmark workloads (see headless.py).
+
+File format, one event per line:
+
+    gasman-input 1 <level_idx> <hz> <velocityIterations> <positionIterations>
+    <step> <command> [int args...]
+    ...
+    <steps> end
+
+Commands:
+    play            the level starts (state.STATE_PLAY)
+    fart            the gas man farts (if he has farts left)
+    keys [k...]     the LEFT / RIGHT keys pressed, torque applied
+'''
+
+import os
+import time
+
+__all__ = [ 'InputRecorder', 'InputLog', 'InputPlayer', 'load', 'new_name' ]
+
+MAGIC = 'gasman-input'
+VERSION = 1
+
+class InputRecorder( object ):
+    '''Logs the input commands of one GameLayer'''
+
+    def __init__( self, level_idx, hz, velocity_iterations, position_iterations ):
+        self.level_idx = level_idx
+        self.hz = hz
+        self.velocity_iterations = velocity_iterations
+        self.position_iterations = position_iterations
+        self.events = []
+
+    def record( self, step, command, *args ):
+        self.events.append( (step, command, tuple(args)) )
+
+    def save( self, path, steps ):
+        lines = [ '%s %d %d %r %d %d' % ( MAGIC, VERSION, self.level_idx, float(self.hz),
+                        self.velocity_iterations, self.position_iterations ) ]
+        for step, command, args in self.events:
+            lines.append( ' '.join( [ str(step), command ] + [ str(a) for a in args ] ) )
+        lines.append( '%d end' % steps )
+
+        try:
+            directory = os.path.dirname( path )
+            if directory and not os.path.isdir( directory ):
+                os.makedirs( directory )
+            f = open( path, 'w' )
+            f.write( '\n'.join( lines ) + '\n' )
+            f.close()
+        except (IOError, OSError), ex:
+            print "input_replay: can't write %s: %s" % (path, ex)
+
+class InputLog( object ):
+    '''A recorded level run'''
+
+    def __init__( self, level_idx, hz, velocity_iterations, position_iterations, events, steps ):
+        self.level_idx = level_idx
+        self.hz = hz
+        self.velocity_iterations = velocity_iterations
+        self.position_iterations = position_iterations
+        self.events = events
+        self.steps = steps
+
+def load( path ):
+    f = open( path )
+    lines = f.read().split( '\n' )
+    f.close()
+
+    header = lines[0].split()
+    if len(header) != 6 or header[0] != MAGIC:
+        raise ValueError( '%s is not an input log' % path )
+    if int( header[1] ) != VERSION:
+        raise ValueError( '%s: unsupported input log version %s' % (path, header[1]) )
+    level_idx, vel_iters, pos_iters = [ int(v) for v in (header[2], header[4], header[5]) ]
+    # hz is a float: 60, but also 59.94
+    hz = float( header[3] )
+
+    events = []
+    steps = None
+    for line in lines[1:]:
+        fields = line.split()
+        if not fields:
+            continue
+        step, command = int( fields[0] ), fields[1]
+        if command == 'end':
+            steps = step
+            break
+        events.append( (step, command, tuple( [ int(a) for a in fields[2:] ] )) )
+
+    if steps is None:
+        raise ValueError( '%s: truncated input log' % path )
+    return InputLog( level_idx, hz, vel_iters, pos_iters, events, steps )
+
+class InputPlayer( object ):
+    '''Feeds the commands of an InputLog to a GameLayer before each physics step'''
+
+    def __init__( self, log ):
+        self.log = log
+        self.idx = 0
+
+    def apply( self, layer, step ):
+        events = self.log.events
+        while self.idx < len(events) and events[ self.idx ][0] <= step:
+            step, command, args = events[ self.idx ]
+            layer.replay_command( command, args )
+            self.idx += 1
+
+_session = time.strftime( '%Y%m%d-%H%M%S' )
+_serial = 0
+
+def new_name( level_idx ):
+    '''a new name for the recordings (input log, body trace) of a level run'''
+    global _serial
+    _serial += 1
+    return '%s-%03d-level%02d' % (_session, _serial, level_idx)
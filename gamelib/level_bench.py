@@ -0,0 +1,189 @@
+'''Per level benchmarks.
+
+For every level of levels.levels measures:
+
+    parse_ms            compiling the level svg (svg_box2d_parser), cold
+    background_ms       decoding the background png
+    sprites_ms          tessellating and compiling the svg sprites, cold
+                        (GameLayer.on_enter, without the tessellation cache)
+    physics_*_ms        mean / p95 / p99 of --benchSteps physics steps
+    draw_ms             mean submission time of GameLayer.visit(), over
+                        --benchFrames frames (glFinish not included)
+
+sprites_ms and draw_ms need GL: with --headless they are null.
+
+The results are written as JSON to --benchOutput. Given a previous
+output with --benchBaseline, a level metric slower than the baseline by
+more than --benchThreshold (0.25 == 25%) is a regression, and the exit
+status is 1.
+
+Usage:
+    python run_game.py --bench [--headless] [--benchBaseline=old.json]
+'''
+
+import json
+import sys
+import time
+
+import pyglet
+from cocos.director import director
+
+# locals
+from state import state
+import levels
+import svg_box2d_parser
+import squirtle_cocos_adaptor as sqa
+import game_scene
+import headless
+from benchmarks import best_time
+from settings import fwSettings
+
+__all__ = [ 'bench_level', 'compare', 'main' ]
+
+VERSION = 1
+
+# metrics compared against the baseline
+METRICS = ( 'parse_ms', 'background_ms', 'sprites_ms', 'physics_mean_ms',
+            'physics_p95_ms', 'physics_p99_ms', 'draw_ms' )
+
+# differences smaller than this are noise, whatever the ratio
+MIN_REGRESSION_MS = 0.1
+
+
+def bench_parse( idx ):
+    level = levels.get_level_filename( idx )
+    parser_class = svg_box2d_parser.parsers[ fwSettings.levelParser ]
+    def parse():
+        svg_box2d_parser.compiled_levels.clear()
+        parser_class( None, level, ratio=game_scene.PTM_RATIO ).compile()
+    return best_time( parse, 3 ) * 1000
+
+def bench_background( idx ):
+    name = levels.get_level_background( idx )
+    try:
+        pyglet.resource.file( name ).close()
+    except pyglet.resource.ResourceNotFoundException:
+        return None
+    def decode():
+        f = pyglet.resource.file( name )
+        try:
+            pyglet.image.load( name, file=f )
+        finally:
+            f.close()
+    return best_time( decode, 3 ) * 1000
+
+def bench_level( idx, with_gl ):
+    result = {
+        'idx' : idx,
+        'name' : levels.get_level_name( idx ),
+        'file' : levels.get_level_filename( idx ),
+        }
+    result['parse_ms'] = bench_parse( idx )
+    result['background_ms'] = bench_background( idx )
+
+    state.reset()
+    state.set_level( idx )
+    if with_gl:
+        layer = headless.SilentGameLayer()
+
+        # the sprites are compiled when the layer enters the scene
+        sqa.geometry_cache.clear()
+        start = time.time()
+        layer.on_enter()
+        result['sprites_ms'] = (time.time() - start) * 1000
+    else:
+        layer = headless.HeadlessGameLayer()
+        result['sprites_ms'] = None
+    state.state = state.STATE_PLAY
+
+    dt = 1.0 / fwSettings.hz
+    timings = []
+    for i in xrange( fwSettings.benchSteps ):
+        start = time.time()
+        layer.main_loop( dt )
+        timings.append( (time.time() - start) * 1000 )
+    result['physics_mean_ms'] = sum( timings ) / max( len(timings), 1 )
+    result['physics_p95_ms'] = headless.percentile( timings, 95 )
+    result['physics_p99_ms'] = headless.percentile( timings, 99 )
+    result['bodies'] = layer.world.GetBodyCount()
+
+    if with_gl:
+        timings = []
+        for i in xrange( fwSettings.benchFrames ):
+            start = time.time()
+            layer.visit()
+            timings.append( (time.time() - start) * 1000 )
+        pyglet.gl.glFinish()
+        result['draw_ms'] = sum( timings ) / max( len(timings), 1 )
+        layer.on_exit()
+    else:
+        result['draw_ms'] = None
+
+    return result
+
+def compare( results, baseline, threshold ):
+    '''Returns the regressions: (level file, metric, baseline, new)'''
+    old_levels = dict( [ (level['file'], level) for level in baseline['levels'] ] )
+    regressions = []
+    for level in results['levels']:
+        old = old_levels.get( level['file'] )
+        if not old:
+            continue
+        for metric in METRICS:
+            new_value, old_value = level.get( metric ), old.get( metric )
+            if new_value is None or old_value is None:
+                continue
+            if new_value > old_value * (1 + threshold) and new_value - old_value > MIN_REGRESSION_MS:
+                regressions.append( (level['file'], metric, old_value, new_value) )
+    return regressions
+
+def format_ms( value ):
+    if value is None:
+        return '%9s' % '-'
+    return '%9.3f' % value
+
+def main():
+    with_gl = not fwSettings.headless
+    if with_gl:
+        director.init( width=800, height=600, visible=False )
+        director.set_depth_test( True )
+    else:
+        headless.init_director()
+
+    pyglet.resource.path.append( 'data' )
+    pyglet.resource.reindex()
+
+    # measure the tessellation, not the cache
+    sqa.SVG_CacheNode.cache_dir = None
+
+    print '%-4s %-24s %9s %9s %9s %9s %9s %9s %9s' % ( 'idx', 'level', 'parse', 'bg', 'sprites',
+            'phys', 'p95', 'p99', 'draw' )
+    results = {
+        'version' : VERSION,
+        'hz' : fwSettings.hz,
+        'steps' : fwSettings.benchSteps,
+        'frames' : fwSettings.benchFrames,
+        'level_parser' : fwSettings.levelParser,
+        'gl' : with_gl,
+        'levels' : [],
+        }
+    for idx in xrange( len( levels.levels ) ):
+        r = bench_level( idx, with_gl )
+        results['levels'].append( r )
+        print '%-4d %-24s %s' % ( idx, r['name'], ' '.join( [ format_ms( r[m] ) for m in METRICS ] ) )
+
+    f = open( fwSettings.benchOutput, 'w' )
+    json.dump( results, f, indent=1, sort_keys=True )
+    f.close()
+    print 'results written to %s' % fwSettings.benchOutput
+
+    if fwSettings.benchBaseline:
+        f = open( fwSettings.benchBaseline )
+        baseline = json.load( f )
+        f.close()
+        regressions = compare( results, baseline, fwSettings.benchThreshold )
+        for name, metric, old, new in regressions:
+            print 'REGRESSION %s %s: %.3f ms -> %.3f ms (%+.0f%%)' % ( name, metric, old, new, (new - old) / max( old, 1e-9 ) * 100 )
+        if regressions:
+            sys.exit( 1 )
+        print 'no regressions against %s' % fwSettings.benchBaseline
@@ -0,0 +1,81 @@
+'''Background loading of the next level.
+
+While the "level complete" message is shown, a worker thread compiles the
+level svg (see svg_box2d_parser.compiled_levels) and decodes its background
+png. The parts that need GL, like creating the textures, can't run in the
+worker: they are done in the main thread, one small job per frame, by step().
+'''
+
+import threading
+
+import pyglet
+
+# locals
+import levels
+import svg_box2d_parser
+
+__all__ = [ 'LevelPrefetcher' ]
+
+
+class LevelPrefetcher( object ):
+
+    def __init__( self, level_idx, ratio, parser_class=svg_box2d_parser.SVGBox2dParser ):
+        self.level_idx = level_idx
+        self.ratio = ratio
+        self.parser_class = parser_class
+
+        # decoded in the worker thread
+        self.background_image = None
+
+        # created in the main thread
+        self.background = None
+
+        # GL jobs, run in the main thread. One per step()
+        self.jobs = [ self.create_background_texture ]
+
+        self.thread = threading.Thread( target=self.run )
+        self.thread.setDaemon( True )
+        self.thread.start()
+
+    def run( self ):
+        # worker thread: don't call GL from here
+        level = levels.get_level_filename( self.level_idx )
+        try:
+            self.parser_class( None, level, ratio=self.ratio ).compile()
+        except Exception, e:
+            # the main thread will parse it again, and report the error
+            print 'Error prefetching level %s: %s' % ( level, e )
+
+        name = levels.get_level_background( self.level_idx )
+        try:
+            f = pyglet.resource.file( name )
+            try:
+                self.background_image = pyglet.image.load( name, file=f )
+            finally:
+                f.close()
+        except Exception:
+            # level without background
+            self.background_image = None
+
+    def step( self ):
+        '''Runs the next GL job, if the worker finished.
+        Returns True when there is nothing left to do'''
+        if self.thread.isAlive():
+            return False
+        if self.jobs:
+            job = self.jobs.pop(0)
+            job()
+        return not self.jobs
+
+    def finish( self ):
+        '''Waits for the worker, and runs all the pending GL jobs'''
+        self.thread.join()
+        while not self.step():
+            pass
+
+    #
+    # GL jobs
+    #
+    def create_background_texture( self ):
+        if self.background_image:
+            self.background = self.background_image.get_texture()
@@ -25,5 +25,8 @@ levels = (
 def get_level_filename( idx ):
     return 'levels/%s.svg' % (levels[idx][1])
 
+def get_level_background( idx ):
+    return 'levels/%s.png' % (levels[idx][1])
+
 def get_level_name( idx ):
     return levels[idx][0]
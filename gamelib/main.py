@@ -6,8 +6,16 @@ Feel free to put all your game code here, or in other modules in this "gamelib"
 package.
 '''
 
-from pyglet.gl import *
 import pyglet
+from settings import fwSettings
+if fwSettings.headless or fwSettings.replay:
+    # no window: don't let pyglet.gl create its shadow window, nor check
+    # the GL calls done at import time (squirtle's tessellator)
+    pyglet.options['shadow_window'] = False
+    pyglet.options['debug_gl'] = False
+    pyglet.options['audio'] = ('silent',)
+
+from pyglet.gl import *
 import cocos
 from cocos.director import director
 
@@ -16,14 +24,44 @@ from menu_scene import *
 from intro_scene import *
 
 import data
+import squirtle_cocos_adaptor
+import soundex
 
 def main():
 
+    if fwSettings.microbench:
+        import benchmarks
+        benchmarks.main( fwSettings.microbench )
+        return
+
+    if fwSettings.bench:
+        import level_bench
+        level_bench.main()
+        return
+
+    if fwSettings.headless:
+        import headless
+        headless.main()
+        return
+
+    if fwSettings.replay:
+        import headless
+        headless.replay_main()
+        return
+
     pyglet.resource.path.append('data')
     pyglet.resource.reindex()
     font.add_directory('data')
     font.add_directory('data/fonts')
 
+    if fwSettings.svgCacheDir:
+        squirtle_cocos_adaptor.SVG_CacheNode.cache_dir = fwSettings.svgCacheDir
+
+    soundex.music_decode_ahead = fwSettings.musicDecodeAhead
+    if fwSettings.soundCacheDir:
+        soundex.cache_dir = fwSettings.soundCacheDir
+    soundex.preload( fwSettings.soundVoices )
+
     director.init( width=800, height=600)
     director.set_depth_test(True)
 
@@ -45,6 +45,31 @@ class fwSettings(object):
     pointSize=2.5 # python version (pixel radius for drawing points)
     drawMenu=True #toggle by pressing F1
     onlyInit=False # run the test's initialization without graphics, and then quit (for testing)
+    fixedTimestep=True # gas man: step the physics in fixed 1/hz steps, interpolating the sprites
+    maxSubSteps=5 # gas man: max physics steps per rendered frame before dropping the backlog
+    validateWorld=False # gas man: call world.Validate() after every step (debug)
+    bakeStaticGeometry=True # gas man: bake the static bodies into a display list instead of using box2d debug draw
+    levelParser='iterparse' # gas man: level svg parser backend: iterparse or minidom
+    svgCacheDir='svg_cache' # gas man: directory for the tessellated sprite svgs ('' disables the cache)
+    rasterSprites=False # gas man: draw the svg sprites as textures rasterized through a framebuffer object
+    soundVoices=8 # gas man: max sound effects playing at the same time
+    soundCacheDir='sound_cache' # gas man: directory for the mp3 sound effects transcoded to wav ('' disables the cache)
+    musicDecodeAhead=16 # gas man: music packets decoded ahead by a worker thread (0 == decode on the main thread)
+    microbench='' # gas man: run the named micro benchmark (see benchmarks.py) and quit
+    recordInput='' # gas man: directory where the input of every level run is recorded ('' disables it)
+    replay='' # gas man: replay the recorded input file headless and report the per step timings
+    replayTimings='' # gas man: file where --replay writes the milliseconds of every step
+    recordTrace='' # gas man: directory where the body positions of every level run are recorded ('' disables it)
+    traceKeyframes=60 # gas man: steps between the keyframes of the body traces
+    bench=False # gas man: benchmark every level (parse, background, sprites, physics, draw) and quit
+    benchSteps=600 # gas man: physics steps timed per level by --bench
+    benchFrames=60 # gas man: frames drawn per level by --bench
+    benchOutput='bench.json' # gas man: file where --bench writes its JSON results
+    benchBaseline='' # gas man: JSON results of a previous --bench. Exits with 1 if a level regressed
+    benchThreshold=0.25 # gas man: slowdown against --benchBaseline reported as a regression (0.25 == 25%)
+    headless=False # gas man: simulate the levels without a window and report steps per second
+    headlessSteps=3600 # gas man: physics steps simulated per level in headless mode
+    headlessLevel=-1 # gas man: level index to simulate in headless mode (-1 == all the levels)
 
 from optparse import OptionParser
 
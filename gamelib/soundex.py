@@ -2,6 +2,14 @@
 # original file from http://www.partiallydisassembled.net/make_me/
 # modified later for this game
 #
+import hashlib
+import os
+import struct
+import threading
+import time
+import wave
+from collections import deque
+
 from constants import MUSIC, SOUND
 import pyglet
 
@@ -23,6 +31,145 @@ current_music = None
 sound_vol = 0.7
 music_player.volume = 0.4
 
+# number of decoded packets kept ahead of the music player (0 == decode
+# in the player refill, on the main thread)
+music_decode_ahead = 0
+
+class DecodeAheadSource( pyglet.media.StreamingSource ):
+    '''Wraps a streaming source. A worker thread decodes it ahead into a
+    bounded ring of AudioData packets, and the player only pops them.
+
+    An underrun happens when the player asks for data and the ring is
+    empty: the main thread has to wait for the worker.
+    '''
+
+    def __init__( self, source, depth=16 ):
+        self.source = source._get_queue_source()
+        self.audio_format = source.audio_format
+        self._duration = source.duration
+        self.depth = max( 1, depth )
+
+        self.ring = deque()
+        self.cond = threading.Condition()
+        self.decode_lock = threading.Lock()
+        self.generation = 0
+        self.eos = False
+        self.stopped = False
+
+        self.packets = 0
+        self.underruns = 0
+        self.stall_time = 0.0
+
+        self.thread = threading.Thread( target=self.run )
+        self.thread.setDaemon( True )
+        self.thread.start()
+
+    def run( self ):
+        cond = self.cond
+        while True:
+            cond.acquire()
+            try:
+                while not self.stopped and (self.eos or len(self.ring) >= self.depth):
+                    cond.wait()
+                if self.stopped:
+                    return
+                generation = self.generation
+            finally:
+                cond.release()
+
+            self.decode_lock.acquire()
+            try:
+                if generation != self.generation:
+                    continue
+                # avbin ignores the size and returns a whole packet
+                data = self.source._get_audio_data( 4096 )
+            finally:
+                self.decode_lock.release()
+
+            cond.acquire()
+            try:
+                # a seek happened while decoding
+                if generation != self.generation:
+                    continue
+                if data is None:
+                    self.eos = True
+                else:
+                    self.ring.append( data )
+                    self.packets += 1
+                cond.notifyAll()
+            finally:
+                cond.release()
+
+    def _get_audio_data( self, bytes ):
+        cond = self.cond
+        cond.acquire()
+        try:
+            if not self.ring and not self.eos:
+                self.underruns += 1
+                start = time.time()
+                while not self.ring and not self.eos and not self.stopped:
+                    cond.wait()
+                self.stall_time += time.time() - start
+            if not self.ring:
+                return None
+            data = self.ring.popleft()
+            cond.notifyAll()
+            return data
+        finally:
+            cond.release()
+
+    def _seek( self, timestamp ):
+        self.decode_lock.acquire()
+        try:
+            self.cond.acquire()
+            try:
+                self.source._seek( timestamp )
+                self.generation += 1
+                self.ring.clear()
+                self.eos = False
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+        finally:
+            self.decode_lock.release()
+
+    def _play( self ):
+        self.source._play()
+
+    def _pause( self ):
+        self.source._pause()
+
+    def _stop( self ):
+        self.cond.acquire()
+        try:
+            self.stopped = True
+            self.ring.clear()
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        self.source._stop()
+
+    def stats( self ):
+        self.cond.acquire()
+        try:
+            return { 'depth' : self.depth,
+                    'buffered' : len( self.ring ),
+                    'packets' : self.packets,
+                    'underruns' : self.underruns,
+                    'stall_time' : self.stall_time }
+        finally:
+            self.cond.release()
+
+def music_source( name ):
+    source = pyglet.resource.media(name, streaming=True)
+    if music_decode_ahead > 0 and source.audio_format:
+        source = DecodeAheadSource( source, music_decode_ahead )
+    return source
+
+def music_stats():
+    '''stats of the decode ahead sources queued in the music player'''
+    return [ s.stats() for s in music_player._sources if isinstance( s, DecodeAheadSource ) ]
+
 def set_music(name):
     global current_music
 
@@ -37,7 +184,7 @@ def set_music(name):
         return
 
     music_player.next()
-    music_player.queue(pyglet.resource.media(name, streaming=True))
+    music_player.queue(music_source(name))
     music_player.play()
     # pyglet bug
     music_player.volume = music_player.volume
@@ -55,7 +202,7 @@ def queue_music(name):
 #    if name == current_music:
 #        return
 
-    music_player.queue(pyglet.resource.media(name, streaming=True))
+    music_player.queue(music_source(name))
     music_player.eos_action = 'next'
 
 
@@ -68,7 +215,7 @@ def play_music():
 
     name = current_music
     music_player.next()
-    music_player.queue(pyglet.resource.media(name, streaming=True))
+    music_player.queue(music_source(name))
     music_player.play()
     music_player.eos_action = 'loop'
 
@@ -85,22 +232,170 @@ def stop_music():
 #
 # SOUND
 #
+
+# every sound effect of the game, with its priority.
+# When all the voices are busy, a sound steals the voice of the oldest
+# sound with a lower or equal priority. Otherwise it is dropped.
+manifest = {
+    'sounds/move.mp3' : 0,
+    'sounds/fart_01.mp3' : 1,
+    'sounds/fart_02.mp3' : 1,
+    'sounds/fart_03.mp3' : 1,
+    'sounds/fart_04.mp3' : 1,
+    'sounds/fart_05.mp3' : 1,
+    'sounds/fart_06.mp3' : 1,
+    'sounds/fart_08.mp3' : 1,
+    'sounds/fart_09.mp3' : 1,
+    'sounds/fart_10.mp3' : 1,
+    'sounds/fart_11.mp3' : 1,
+    'sounds/crunch_01.mp3' : 2,
+    'sounds/powerup_01.wav' : 3,
+    'sounds/ouch_01.wav' : 3,
+    'sounds/scream_01.mp3' : 4,
+    'sounds/level_complete_01.mp3' : 5,
+    'sounds/game_over_01.mp3' : 5,
+    'sounds/you_win.mp3' : 5,
+}
+default_priority = 1
+
+class VoicePool( object ):
+    '''A fixed number of voices shared by all the sound effects'''
+
+    def __init__( self, size=8 ):
+        self.size = size
+        # (priority, serial, player)
+        self.voices = []
+        self.serial = 0
+        self.played = 0
+        self.stolen = 0
+        self.dropped = 0
+
+    def reap( self ):
+        # a ManagedSoundPlayer drops its source once it reaches the end
+        self.voices = [ v for v in self.voices if v[2].source is not None ]
+
+    def active( self ):
+        self.reap()
+        return len( self.voices )
+
+    def play( self, source, priority ):
+        self.reap()
+        if len( self.voices ) >= self.size:
+            victim = min( self.voices )
+            if victim[0] > priority:
+                self.dropped += 1
+                return None
+            self.voices.remove( victim )
+            victim[2].pause()
+            victim[2].stop()
+            self.stolen += 1
+
+        player = source.play()
+        player.volume = sound_vol
+        self.serial += 1
+        self.voices.append( (priority, self.serial, player) )
+        self.played += 1
+        return player
+
+    def stop_all( self ):
+        for priority, serial, player in self.voices:
+            if player.source is not None:
+                player.pause()
+                player.stop()
+        self.voices = []
+
+    def stats( self ):
+        return { 'voices' : self.size,
+                'active' : self.active(),
+                'played' : self.played,
+                'stolen' : self.stolen,
+                'dropped' : self.dropped }
+
+class Sound( object ):
+    '''A sound effect decoded once. play() goes through the voice pool'''
+
+    def __init__( self, name, source, priority ):
+        self.name = name
+        self.source = source
+        self.priority = priority
+
+    def play( self ):
+        return voices.play( self.source, self.priority )
+
+voices = VoicePool()
 sounds = {}
 
-def load(name, streaming=False):
+# directory for the compressed sound effects transcoded to PCM wav files
+# (None == decode them with avbin on every launch)
+cache_dir = None
+transcode_extensions = ('.mp3', '.ogg')
+
+def save_wav( path, source ):
+    '''writes the decoded data of a StaticSource as a PCM wav file'''
+    tmp_path = path + '.tmp'
+    try:
+        if not os.path.isdir( cache_dir ):
+            os.makedirs( cache_dir )
+        f = wave.open( tmp_path, 'wb' )
+        f.setnchannels( source.audio_format.channels )
+        f.setsampwidth( source.audio_format.sample_size / 8 )
+        f.setframerate( source.audio_format.sample_rate )
+        f.writeframes( source._data )
+        f.close()
+        if os.path.exists( path ):
+            os.remove( path ) # win32 rename don't overwrite
+        os.rename( tmp_path, path )
+    except (IOError, OSError, wave.Error), ex:
+        print "soundex: can't write the sound cache %s: %s" % (path, ex)
+
+def transcoded_source( name ):
+    '''decodes a compressed sound effect once, and keeps its PCM data
+    in cache_dir, keyed by the hash of the compressed file'''
+    f = pyglet.resource.file( name )
+    digest = hashlib.sha1( f.read() ).hexdigest()
+    f.close()
+
+    path = os.path.join( cache_dir, digest + '.wav' )
+    if os.path.exists( path ):
+        try:
+            from pyglet.media import riff
+            return pyglet.media.StaticSource( riff.WaveSource( path ) )
+        except (IOError, struct.error, pyglet.media.MediaException), ex:
+            print 'soundex: ignoring the sound cache %s: %s' % (path, ex)
+
+    source = pyglet.resource.media(name, streaming=False)
+    if source.audio_format:
+        save_wav( path, source )
+    return source
+
+def load(name):
     if not SOUND:
         return
 
     if name not in sounds:
-        sounds[name] = pyglet.resource.media(name, streaming=streaming)
+        if cache_dir and os.path.splitext( name )[1].lower() in transcode_extensions:
+            source = transcoded_source( name )
+        else:
+            source = pyglet.resource.media(name, streaming=False)
+        sounds[name] = Sound( name, source, manifest.get( name, default_priority ) )
 
     return sounds[name]
 
+def preload( max_voices=None ):
+    '''decodes every sound of the manifest. Call it once at startup'''
+    if max_voices is not None:
+        voices.size = max( 1, max_voices )
+
+    if not SOUND:
+        return
+
+    for name in sorted( manifest ):
+        load( name )
+
 def play(name):
     if not SOUND:
         return
-    load(name)
-    a = sounds[name].play().volume = sound_vol
+    return load(name).play()
 
 def sound_volume( vol ):
     global sound_vol
@@ -67,10 +67,58 @@ class SVG_CacheNode:
         Set and unset a fine open gl state to draw the SVG nodes.
 
     Aditional notes:
-    You can have more than one SVG_CacheCode, but caching would not apply
-    across diferent cache nodes.
+    You can have more than one SVG_CacheCode; they all share the display
+    lists through geometry_cache.
     Childs must be SVGnodes.
 
+class SVG_BatchNode:
+    a SVG_CacheNode that draws many SVGnodes cheaply
+    Responsabilities:
+        draw the visible childs one by one, in z order, each with one
+        glLoadMatrixf + glCallList, the matrix computed in python from the
+        batch modelview matrix. No glPush/PopMatrix nor CocosNode.transform
+        per child.
+
+    Aditional notes:
+    Despite the name, it is not a batch in the GL sense: it still does one
+    draw call per child, not one per descriptor. Merging the childs of a
+    descriptor into one vertex array would mean transforming their
+    vertices on the CPU every frame, which costs more in python than the
+    calls it saves.
+    The childs are placed with the anchor point at position, then rotated
+    and scaled around it (what you get with a SVGnode child of a positioned
+    SVG_CacheNode). Their own childs, grid and camera are ignored.
+
+class SVG_RasterCache:
+    the process wide cache of rasterized svgs (module instance: raster_cache)
+    Responsabilities:
+        render a display list once into a texture through a framebuffer
+        object, at a scale rounded to a power of scale_step, so all the
+        nodes with about the same on screen scale share one texture.
+
+        keep up to max_textures textures, least recently used dropped first.
+
+    Aditional notes:
+    The textures hold premultiplied alpha; draw them with
+    glBlendFunc(GL_ONE, GL_ONE_MINUS_SRC_ALPHA).
+    If framebuffer objects are not available a warning is printed and
+    get() returns None from then on.
+
+class SVG_GeometryCache:
+    the process wide cache behind the SVG_CacheNodes (module instance:
+    geometry_cache).
+    Responsabilities:
+        reference counting: each SVG_CacheNode holds one reference for each
+        descriptor its childs use, and releases them in on_exit.
+
+        LRU eviction: display lists nobody references are kept, up to
+        max_unused of them, so a level restart don't convert the svgs again.
+        The least recently used is deleted first.
+
+        stats: geometry_cache.stats() returns a dict with the hits, misses,
+        evictions, entries, referenced entries and the bytes of vertex data
+        held by GL.
+
 class SVGnode:
     A cocosnode subclass to display a svg file
 
@@ -100,6 +148,19 @@ class SVGnode:
     Note that the bounding box and size related members are untransformed values,
     ie dont reflect any rotation or scale.
 
+    With raster=True the node is drawn as a textured quad, the svg
+    rasterized by raster_cache at the node on screen scale. A new texture
+    is only rasterized when that scale moves to another scale_step.
+    lod is ignored for raster nodes.
+
+    With lod=True the node picks, each frame, a level of detail from
+    lod_tiers by its on screen size (bounding box times the scales of the
+    node and its ancestors). Small nodes use fewer bezier / circle
+    segments; above the last tier the node uses its own bezier_divs and
+    circle_divs. Each tier is converted the first time it is needed, and
+    the node only changes tier when its size leaves the tier by more than
+    lod_hysteresis, so it don't thrash around a threshold.
+
     The anchor_hint parameter values follow the rosewind analogy, with the
     aditional value 'CC' meaning center. Examples: 'SW' refers to the bounding
     box lower left corner, 'N' (or 'CN' or 'NC') refers to the bb top segment
@@ -117,25 +178,185 @@ or, if fits the cocos-discuss list, mail there.
 
 """
 import os
+import math
+from collections import OrderedDict
+from ctypes import sizeof, byref
 
 from pyglet.gl import *
+from pyglet import image
 import cocos
+from cocos.gl_framebuffer_object import FramebufferObject
 import squirtle_core
 
 
+class SVG_GeometryCache(object):
+    def __init__(self, max_unused=8):
+        self.max_unused = max_unused
+        self.entries = {} # <descriptor> : pre_render result
+        self.sizes = {} # <descriptor> : bytes of vertex data
+        self.refs = {} # <descriptor> : reference count
+        self.unused = OrderedDict() # unreferenced descriptors, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def acquire(self, descriptor, vertex_arrays=False, cache_dir=None):
+        if descriptor in self.entries:
+            self.hits += 1
+        else:
+            self.misses += 1
+            filename, bezier_divs, circle_divs = descriptor
+            pre = squirtle_core.SVG_pre_render(filename, bezier_divs, circle_divs,
+                                               vertex_arrays=vertex_arrays,
+                                               cache_dir=cache_dir)
+            self.entries[descriptor] = pre.get_result()
+            if vertex_arrays:
+                self.sizes[descriptor] = sizeof(pre.vertices) + sizeof(pre.colors)
+            else:
+                # glVertex3f + glColor4ub
+                self.sizes[descriptor] = (3 * pre.n_tris + 2 * pre.n_lines) * 16
+            self.refs[descriptor] = 0
+        self.refs[descriptor] += 1
+        self.unused.pop(descriptor, None)
+        return self.entries[descriptor]
+
+    def release(self, descriptor):
+        self.refs[descriptor] -= 1
+        if self.refs[descriptor] == 0:
+            self.unused[descriptor] = True
+            while len(self.unused) > self.max_unused:
+                oldest, unused = self.unused.popitem(last=False)
+                self.evict(oldest)
+
+    def evict(self, descriptor):
+        self.evictions += 1
+        id_list = self.entries.pop(descriptor)[0]
+        glDeleteLists(id_list, 1)
+        del self.sizes[descriptor]
+        del self.refs[descriptor]
+
+    def clear(self):
+        """deletes the display lists nobody references"""
+        for descriptor in self.unused.keys():
+            self.evict(descriptor)
+        self.unused.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'referenced': len(self.entries) - len(self.unused),
+            'gl_bytes': sum(self.sizes.values()),
+            }
+
+geometry_cache = SVG_GeometryCache()
+
+
+class SVG_RasterCache(object):
+    padding = 1 # transparent pixels around the svg, for the linear filtering
+
+    def __init__(self, scale_step=1.25, max_textures=32):
+        self.scale_step = scale_step
+        self.max_textures = max_textures
+        self.textures = OrderedDict() # (descriptor, scale step) : (texture, scale)
+        self.fbo = None
+        self.available = True
+        self.rasterized = 0
+
+    def get(self, descriptor, display_list, bounds, scale):
+        step = int(round(math.log(scale, self.scale_step)))
+        key = descriptor, step
+        if key in self.textures:
+            entry = self.textures.pop(key)
+        elif not self.available:
+            return None
+        else:
+            try:
+                entry = self.rasterize(display_list, bounds, self.scale_step ** step)
+            except Exception, ex:
+                print 'Warning: svg rasterization disabled: %s' % ex
+                self.available = False
+                return None
+            while len(self.textures) >= self.max_textures:
+                self.textures.popitem(last=False)
+        self.textures[key] = entry
+        return entry
+
+    def rasterize(self, display_list, bounds, scale):
+        min_x, max_x, min_y, max_y = bounds
+        pad = self.padding
+        width = int(math.ceil((max_x - min_x) * scale)) + 2 * pad
+        height = int(math.ceil((max_y - min_y) * scale)) + 2 * pad
+        texture = image.Texture.create(width, height, GL_RGBA)
+
+        # the frame may be drawn into another framebuffer (cocos grid
+        # effects): restore that one, not the window's
+        previous = GLint()
+        glGetIntegerv(GL_FRAMEBUFFER_BINDING_EXT, byref(previous))
+        if self.fbo is None:
+            self.fbo = FramebufferObject()
+        self.fbo.bind()
+        try:
+            self.fbo.texture2d(texture)
+            self.fbo.check_status()
+
+            glPushAttrib(GL_VIEWPORT_BIT | GL_COLOR_BUFFER_BIT | GL_ENABLE_BIT)
+            glViewport(0, 0, width, height)
+            glMatrixMode(GL_PROJECTION)
+            glPushMatrix()
+            glLoadIdentity()
+            glOrtho(0, width, 0, height, -1, 1)
+            glMatrixMode(GL_MODELVIEW)
+            glPushMatrix()
+            glLoadIdentity()
+
+            glDisable(GL_DEPTH_TEST)
+            glClearColor(0, 0, 0, 0)
+            glClear(GL_COLOR_BUFFER_BIT)
+            squirtle_core.setup_gl()
+            # premultiplied color, and an alpha channel that accumulates coverage
+            glBlendFuncSeparate(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA, GL_ONE, GL_ONE_MINUS_SRC_ALPHA)
+            glTranslatef(pad, pad, 0)
+            glScalef(scale, scale, 1)
+            glTranslatef(-min_x, -min_y, 0)
+            glCallList(display_list)
+
+            glMatrixMode(GL_PROJECTION)
+            glPopMatrix()
+            glMatrixMode(GL_MODELVIEW)
+            glPopMatrix()
+            glPopAttrib()
+        finally:
+            glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, previous.value)
+
+        # the texture lower left corner, in svg coordinates times scale
+        texture.anchor_x = pad - min_x * scale
+        texture.anchor_y = pad - min_y * scale
+        self.rasterized += 1
+        return texture, scale
+
+raster_cache = SVG_RasterCache()
+
+
 class SVG_CacheNode(cocos.cocosnode.CocosNode):
+    # build the display lists from packed vertex arrays (see SVG_pre_render)
+    vertex_arrays = True
+    # directory for the tessellation cache, None to disable it
+    cache_dir = None
+
     def __init__(self):
         super(SVG_CacheNode,self).__init__()
-        self.db = {} # <descriptor> : id_list
+        self.db = {} # <descriptor> : pre_render result, referenced in geometry_cache
 
     def on_enter(self):#debug
         super(SVG_CacheNode,self).on_enter()
             
     def on_exit(self):
         super(SVG_CacheNode,self).on_exit()
-        for e in self.db:
-            id_list ,width, height, min_x, max_x, min_y, max_y = self.db[e]
-            glDeleteLists( id_list, 1)
+        for descriptor in self.db:
+            geometry_cache.release(descriptor)
         self.db = {}
 
     def visit(self):
@@ -147,18 +368,53 @@ class SVG_CacheNode(cocos.cocosnode.CocosNode):
         assert( isinstance(child, SVGnode))
         super(SVG_CacheNode,self).add( child, z=z, name=name) 
     
-    #def remove():
-    #better caching would need usage cnt to free unused display lists
-    #for modest childs quantity sufices with free in on_exit 
-
     def pre_render(self, descriptor):
         if descriptor not in self.db:
-            filename , bezier_divs, circle_divs = descriptor
-            id_list ,width, height, min_x, max_x, min_y, max_y = (
-                squirtle_core.SVG_pre_render(filename, bezier_divs, circle_divs).get_result())
-            self.db[descriptor] = (id_list, width, height, min_x, max_x, min_y, max_y)
+            self.db[descriptor] = geometry_cache.acquire(descriptor,
+                                                         vertex_arrays=self.vertex_arrays,
+                                                         cache_dir=self.cache_dir)
         return self.db[descriptor]    
 
+class SVG_BatchNode(SVG_CacheNode):
+    def visit(self):
+        if not self.visible:
+            return
+        squirtle_core.begin_svg()
+        glPushMatrix()
+        self.transform()
+        matrix = (GLfloat * 16)()
+        glGetFloatv(GL_MODELVIEW_MATRIX, matrix)
+        b = list(matrix)
+
+        # in z order: the childs overlap
+        for z, child in self.children:
+            if not child.visible or child.display_list is None:
+                continue
+            if child.lod:
+                child.update_lod()
+
+            # modelview * translate(position) * rotate * scale * translate(anchor)
+            x, y = child.position
+            r = math.radians(-child.rotation)
+            c = math.cos(r) * child.scale
+            s = math.sin(r) * child.scale
+            ax, ay = child.transform_anchor_x, child.transform_anchor_y
+            tx = x + c * ax - s * ay
+            ty = y + s * ax + c * ay
+            matrix[:] = [c*b[0] + s*b[4], c*b[1] + s*b[5], c*b[2] + s*b[6], c*b[3] + s*b[7],
+                         c*b[4] - s*b[0], c*b[5] - s*b[1], c*b[6] - s*b[2], c*b[7] - s*b[3],
+                         b[8], b[9], b[10], b[11],
+                         tx*b[0] + ty*b[4] + b[12], tx*b[1] + ty*b[5] + b[13],
+                         tx*b[2] + ty*b[6] + b[14], tx*b[3] + ty*b[7] + b[15]]
+            glLoadMatrixf(matrix)
+            if child.raster:
+                child.draw_raster()
+            else:
+                glCallList(child.display_list)
+
+        glPopMatrix()
+        squirtle_core.end_svg()
+
 # helper to build common offsets
 def f_rosewind_offset(min_x, max_x, min_y, max_y, selector=None):
     """
@@ -220,13 +476,22 @@ def f_rosewind_offset(min_x, max_x, min_y, max_y, selector=None):
 
 class SVGnode( cocos.cocosnode.CocosNode ):
     is_event_handler = True
+    # (max on screen size in pixels, bezier_divs, circle_divs), smallest first
+    lod_tiers = ((20, 2, 6), (40, 4, 10))
+    lod_hysteresis = 0.15
+
     # params adapted from sprite params
     def __init__(self, filename,
                  bezier_divs=squirtle_core.BEZIER_POINTS, circle_divs=squirtle_core.CIRCLE_POINTS,
-                 position=(0,0), rotation=0, scale=1.0, anchor_hint = None ):
+                 position=(0,0), rotation=0, scale=1.0, anchor_hint = None, lod=False,
+                 raster=False ):
         self.filename = os.path.abspath(filename)
         self.bezier_divs = bezier_divs
         self.circle_divs = circle_divs
+        self.lod = lod and not raster
+        self.raster = raster
+        self.lod_tier = len(self.lod_tiers) # own bezier_divs, circle_divs
+        self.lod_display_lists = {} # tier : display list
         self._anchor_hint = anchor_hint #unused after 1st on_enter 
         self._anchor_from_hint = True
         
@@ -238,6 +503,9 @@ class SVGnode( cocos.cocosnode.CocosNode ):
         self.min_y = None
         self.man_y = None
         self.display_list = None
+        self.cache_group = None
+        self.descriptor = None
+        self.bounds = None
         
         super(SVGnode,self).__init__()
         
@@ -256,6 +524,12 @@ class SVGnode( cocos.cocosnode.CocosNode ):
         display_list, width, height, min_x, max_x, min_y, max_y = (
             cache_group.pre_render(descriptor))
         self.display_list = display_list
+        self.cache_group = cache_group
+        self.lod_display_lists = {}
+        self.lod_tier = len(self.lod_tiers)
+        self.lod_display_lists[self.lod_tier] = display_list
+        self.descriptor = descriptor
+        self.bounds = min_x, max_x, min_y, max_y
         self.fwidth = max_x-min_x
         self.fheight = max_y-min_y
         self.min_x = min_x
@@ -268,10 +542,52 @@ class SVGnode( cocos.cocosnode.CocosNode ):
                                              selector=self._anchor_hint)
         super(SVGnode,self).on_enter()
 
+    def screen_scale(self):
+        scale = 1.0
+        node = self
+        while node is not None:
+            scale *= node.scale
+            node = node.parent
+        return scale
+
+    def update_lod(self):
+        size = max(self.fwidth, self.fheight) * self.screen_scale()
+        tiers = self.lod_tiers
+        tier = self.lod_tier
+        while tier < len(tiers) and size > tiers[tier][0] * (1 + self.lod_hysteresis):
+            tier += 1
+        while tier > 0 and size < tiers[tier - 1][0] * (1 - self.lod_hysteresis):
+            tier -= 1
+        if tier != self.lod_tier:
+            self.lod_tier = tier
+            if tier not in self.lod_display_lists:
+                max_size, bezier_divs, circle_divs = tiers[tier]
+                descriptor = self.filename, bezier_divs, circle_divs
+                self.lod_display_lists[tier] = self.cache_group.pre_render(descriptor)[0]
+            self.display_list = self.lod_display_lists[tier]
+
+    def draw_raster(self):
+        entry = raster_cache.get(self.descriptor, self.display_list, self.bounds,
+                                 self.screen_scale())
+        if entry is None:
+            glCallList(self.display_list)
+            return
+        texture, scale = entry
+        glScalef(1.0 / scale, 1.0 / scale, 1)
+        glColor4f(1, 1, 1, 1)
+        glBlendFunc(GL_ONE, GL_ONE_MINUS_SRC_ALPHA)
+        texture.blit(0, 0)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+
     def draw(self):
+        if self.lod:
+            self.update_lod()
         glPushMatrix() # preserve
         self.transform() #prepare
         # ... draw ..
-        glCallList(self.display_list)
+        if self.raster:
+            self.draw_raster()
+        else:
+            glCallList(self.display_list)
         glPopMatrix() # restore
 
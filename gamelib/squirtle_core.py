@@ -66,8 +66,14 @@ from gl_backend import *
 from xml.etree.cElementTree import parse as cTree_parse
 import re
 import math
-from ctypes import CFUNCTYPE, POINTER, byref, cast
+from collections import deque
+from bisect import bisect_left
+from ctypes import CFUNCTYPE, POINTER, byref, cast, sizeof, string_at
 import sys
+import os
+import struct
+import hashlib
+from cStringIO import StringIO
 
 from svg_colors import svg_named_colors
 
@@ -97,6 +103,11 @@ def set_tess_callback(which):
 BEZIER_POINTS = 10
 CIRCLE_POINTS = 24
 TOLERANCE = 0.001
+
+# tessellation cache file: header, runs, vertices, colors
+CACHE_MAGIC = 'SQC1'
+CACHE_HEADER = '<4s6d4i' # magic, width, height, min_x, max_x, min_y, max_y,
+                         # n_tris, n_lines, n_vertices, n_runs
 def setup_gl():
     """Set various pieces of OpenGL state for better rendering of SVG.
         If the app needs to setup other states, use begin_svg() - end_svg()
@@ -118,7 +129,23 @@ def begin_svg():
 def end_svg():
     glPopAttrib()
     glPopAttrib()
+
+def draw_arrays(vertices, colors, runs):
+    """Draws the packed arrays built by SVG_pre_render.build_arrays.
+        Inside a glNewList the vertex data is copied into the display list.
+    """
+    glPushClientAttrib(GL_CLIENT_VERTEX_ARRAY_BIT)
+    glEnableClientState(GL_VERTEX_ARRAY)
+    glEnableClientState(GL_COLOR_ARRAY)
+    glVertexPointer(2, GL_FLOAT, 0, vertices)
+    glColorPointer(4, GL_UNSIGNED_BYTE, 0, colors)
+    for mode, first, count in runs:
+        glDrawArrays(mode, first, count)
+    glPopClientAttrib()
     
+path_token_re = re.compile("([A-Za-z]|-?[0-9]+\.?[0-9]*(?:e-?[0-9]*)?)")
+point_token_re = re.compile("(-?[0-9]+\.?[0-9]*(?:e-?[0-9]*)?)")
+
 def parse_list(string):
     return re.findall("([A-Za-z]|-?[0-9]+\.?[0-9]*(?:e-?[0-9]*)?)", string)
 
@@ -266,6 +293,38 @@ class Gradient(object):
                 return [int(x[0] * (1 - alpha) + x[1] * alpha) for x in zip(bottom[1], top[1])]
         return self.stops[-1][1]
 
+    def interp_all(self, pts):
+        """Same as [self.interp(pt) for pt in pts], but the colors come
+        flattened (r,g,b,a,r,g,b,a...), ready for a color array.
+        The transform and gradient constants are computed once, and the
+        stop is found by bisection.
+        """
+        if not self.stops: return [255, 0, 255, 255] * len(pts)
+        offsets = [stop[0] for stop in self.stops]
+        colors = [stop[1] for stop in self.stops]
+        first = colors[0]
+        last = colors[-1]
+        n = len(offsets)
+        out = []
+        for t in self.grad_values(pts):
+            if t < offsets[0]:
+                out.extend(first)
+                continue
+            j = bisect_left(offsets, t, 1)
+            if j == n:
+                out.extend(last)
+                continue
+            u = offsets[j - 1]
+            v = offsets[j]
+            alpha = (t - u)/(v - u)
+            b = colors[j - 1]
+            c = colors[j]
+            out.extend((int(b[0] * (1 - alpha) + c[0] * alpha),
+                        int(b[1] * (1 - alpha) + c[1] * alpha),
+                        int(b[2] * (1 - alpha) + c[2] * alpha),
+                        int(b[3] * (1 - alpha) + c[3] * alpha)))
+        return out
+
     def get_params(self, parent):
         for param in self.params:
             v = None
@@ -285,11 +344,28 @@ class LinearGradient(Gradient):
     def grad_value(self, pt):
         return ((pt[0] - self.x1)*(self.x2 - self.x1) + (pt[1] - self.y1)*(self.y2 - self.y1)) / ((self.x1 - self.x2)**2 + (self.y1 - self.y2)**2)
 
+    def grad_values(self, pts):
+        a, b, c, d, e, f = self.inv_transform.values
+        x1 = self.x1
+        y1 = self.y1
+        dx = self.x2 - self.x1
+        dy = self.y2 - self.y1
+        den = (self.x1 - self.x2)**2 + (self.y1 - self.y2)**2
+        return [((a*x + c*y + e - x1)*dx + (b*x + d*y + f - y1)*dy) / den for x, y in pts]
+
 class RadialGradient(Gradient):
     params = ['cx', 'cy', 'r', 'stops']
 
     def grad_value(self, pt):
         return math.sqrt((pt[0] - self.cx) ** 2 + (pt[1] - self.cy) ** 2)/self.r
+
+    def grad_values(self, pts):
+        a, b, c, d, e, f = self.inv_transform.values
+        cx = self.cx
+        cy = self.cy
+        r = self.r
+        sqrt = math.sqrt
+        return [sqrt((a*x + c*y + e - cx) ** 2 + (b*x + d*y + f - cy) ** 2)/r for x, y in pts]
         
 
 
@@ -303,6 +379,15 @@ class SVG_pre_render(object):
         `circle_points`: int
             The number of line segments into which to subdivide circular and elliptic arcs. 
             Defaults to 10.
+        `vertex_arrays`: bool
+            If True, the geometry is packed into ctypes arrays (see build_arrays)
+            and the display list is compiled from them with glDrawArrays,
+            instead of one glVertex call per vertex. Defaults to False.
+        `cache_dir`: str
+            Only with vertex_arrays. Directory where the packed geometry is
+            saved, keyed by (file content hash, bezier_points, circle_points).
+            When a cached file exists, parsing and tessellation are skipped.
+            Defaults to None (no cache).
 
         Usage:
             obj = SVG_pre_render(params).get_result()
@@ -312,29 +397,51 @@ class SVG_pre_render(object):
             min_x,max_x,min_y,max_y: bounding box for the display list
             width, height : calculated from the bounding box
         
+        With vertex_arrays=True the packed geometry is also available:
+            vertices, colors, runs = obj.get_arrays()
+        where:
+            vertices: GLfloat array, x,y,x,y...
+            colors: GLubyte array, r,g,b,a,r,g,b,a...
+            runs: list of (gl mode, first vertex, vertex count) in draw order
+
         Usage legacy, for compatibility with squirtle 2.04:
             display_list , width, height = SVG_pre_render(params).get_legacy_result()
         where:
             display_list: gl display list
             width, height : as stored in the .svg file
     """
-    def __init__(self, filename, bezier_points=BEZIER_POINTS, circle_points=CIRCLE_POINTS):
+    def __init__(self, filename, bezier_points=BEZIER_POINTS, circle_points=CIRCLE_POINTS,
+                 vertex_arrays=False, cache_dir=None):
         self.bezier_points = bezier_points
         self.circle_points = circle_points
         self.bezier_coefficients = []
         self.gradients = GradientContainer()
         self.filename = filename 
         
-        if open(filename, 'rb').read(3) == '\x1f\x8b\x08': #gzip magic numbers
-            import gzip
-            f = gzip.open(filename, 'rb')
-        else:
-            f = open(filename, 'rb')
-        self.tree = cTree_parse(f) #cElementTree
-        self.parse_doc()
+        content = open(filename, 'rb').read()
+        self.cache_filename = None
+        if vertex_arrays and cache_dir:
+            self.cache_filename = os.path.join(cache_dir, '%s-%d-%d.bin' % (
+                hashlib.sha1(content).hexdigest(), bezier_points, circle_points))
+
+        if not (self.cache_filename and self.load_cache(self.cache_filename)):
+            if content[:3] == '\x1f\x8b\x08': #gzip magic numbers
+                import gzip
+                f = gzip.GzipFile(fileobj=StringIO(content), mode='rb')
+            else:
+                f = StringIO(content)
+            self.tree = cTree_parse(f) #cElementTree
+            self.parse_doc()
+            if vertex_arrays:
+                self.build_arrays()
+            if self.cache_filename:
+                self.save_cache(self.cache_filename)
         self.disp_list = glGenLists(1)
         glNewList(self.disp_list, GL_COMPILE)
-        self.render_slowly()
+        if vertex_arrays:
+            draw_arrays(self.vertices, self.colors, self.runs)
+        else:
+            self.render_slowly()
         glEndList()
 
     def get_result(self):
@@ -344,6 +451,61 @@ class SVG_pre_render(object):
     def get_legacy_result(self):
         return self.disp_list, self.width, self.height
 
+    def get_arrays(self):
+        return self.vertices, self.colors, self.runs
+
+    def load_cache(self, path):
+        """Loads the packed geometry saved by save_cache.
+            Returns False if there is no usable cache file.
+        """
+        try:
+            data = open(path, 'rb').read()
+        except IOError:
+            return False
+        header_size = struct.calcsize(CACHE_HEADER)
+        if data[:4] != CACHE_MAGIC or len(data) < header_size:
+            return False
+        (magic, self.width, self.height, self.min_x, self.max_x, self.min_y, self.max_y,
+         self.n_tris, self.n_lines, n_vertices, n_runs) = struct.unpack_from(CACHE_HEADER, data)
+        if len(data) != header_size + 12 * n_runs + 12 * n_vertices:
+            self.warn("Ignoring truncated tessellation cache %s" % path)
+            return False
+
+        offset = header_size
+        runs = struct.unpack_from('<%di' % (3 * n_runs), data, offset)
+        self.runs = zip(runs[0::3], runs[1::3], runs[2::3])
+        offset += 12 * n_runs
+        self.vertices = (GLfloat * (2 * n_vertices)).from_buffer_copy(data, offset)
+        offset += 8 * n_vertices
+        self.colors = (GLubyte * (4 * n_vertices)).from_buffer_copy(data, offset)
+
+        self._width = self.max_x - self.min_x
+        self._height = self.max_y - self.min_y
+        return True
+
+    def save_cache(self, path):
+        n_vertices = len(self.vertices) / 2
+        header = struct.pack(CACHE_HEADER, CACHE_MAGIC, self.width, self.height,
+                             self.min_x, self.max_x, self.min_y, self.max_y,
+                             self.n_tris, self.n_lines, n_vertices, len(self.runs))
+        runs = struct.pack('<%di' % (3 * len(self.runs)), *[v for run in self.runs for v in run])
+        tmp_path = path + '.tmp'
+        try:
+            cache_dir = os.path.dirname(path)
+            if cache_dir and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            f = open(tmp_path, 'wb')
+            f.write(header)
+            f.write(runs)
+            f.write(string_at(self.vertices, sizeof(self.vertices)))
+            f.write(string_at(self.colors, sizeof(self.colors)))
+            f.close()
+            if os.path.exists(path):
+                os.remove(path) # win32 rename don't overwrite
+            os.rename(tmp_path, path)
+        except (IOError, OSError), ex:
+            self.warn("Can't write the tessellation cache: %s" % ex)
+
         
     # users dont need to call any of the following
     def parse_doc(self):
@@ -411,19 +573,21 @@ class SVG_pre_render(object):
         if e.tag.endswith('path'):
             #print '*** path begin ***'
             pathdata = e.get('d', '')               
-            pathdata = re.findall("([A-Za-z]|-?[0-9]+\.?[0-9]*(?:e-?[0-9]*)?)", pathdata)
+            # a deque: popping from the head of a list is O(n)
+            pathdata = deque(path_token_re.findall(pathdata))
+            pop = pathdata.popleft
 
             def opcode_follows():
                 return len(pathdata)==0 or pathdata[0] in 'MmCcSsAaLlHhZzVv'
                 
             def pnext():
-                return (float(pathdata.pop(0)), float(pathdata.pop(0)))
+                return (float(pop()), float(pop()))
 
             self.new_path()
             opnum = -1
             while pathdata:
                 opnum += 1 
-                opcode = pathdata.pop(0)
+                opcode = pop()
                 #print ' opcode:',opcode
                 if opcode == 'M':
                     self.set_position(*pnext())
@@ -460,18 +624,18 @@ class SVG_pre_render(object):
                     self.curve_to(x1, y1, mx + x2, my + y2, mx + x, my + y)
                 elif opcode in 'A':
                     rx, ry = pnext()
-                    phi = float(pathdata.pop(0))
-                    large_arc = int(pathdata.pop(0))
-                    sweep = int(pathdata.pop(0))
+                    phi = float(pop())
+                    large_arc = int(pop())
+                    sweep = int(pop())
                     x, y = pnext()
                     self.arc_to(rx, ry, phi, large_arc, sweep, x, y)
                     #? opcode 'A' allow implicit repeats, as 'a' ? 
                 elif opcode in 'a':
                     while 1:
                         rx, ry = pnext()
-                        phi = float(pathdata.pop(0))
-                        large_arc = int(pathdata.pop(0))
-                        sweep = int(pathdata.pop(0))
+                        phi = float(pop())
+                        large_arc = int(pop())
+                        sweep = int(pop())
                         x, y = pnext()
                         x,y = self.rel_to_abs(x,y)
                         self.arc_to(rx, ry, phi, large_arc, sweep, x, y)
@@ -485,16 +649,16 @@ class SVG_pre_render(object):
                     x, y = pnext()
                     self.line_to(self.x + x, self.y + y)
                 elif opcode == 'H':
-                    x = float(pathdata.pop(0))
+                    x = float(pop())
                     self.line_to(x, self.y)
                 elif opcode == 'h':
-                    x = float(pathdata.pop(0))
+                    x = float(pop())
                     self.line_to(self.x + x, self.y)
                 elif opcode == 'V':
-                    y = float(pathdata.pop(0))
+                    y = float(pop())
                     self.line_to(self.x, y)
                 elif opcode == 'v':
-                    y = float(pathdata.pop(0))
+                    y = float(pop())
                     self.line_to(self.x, self.y + y)
                 else:
                     self.warn("Unrecognised opcode: " + opcode)
@@ -514,9 +678,10 @@ class SVG_pre_render(object):
             self.end_path()
         elif e.tag.endswith('polyline') or e.tag.endswith('polygon'):
             pathdata = e.get('points')
-            pathdata = re.findall("(-?[0-9]+\.?[0-9]*(?:e-?[0-9]*)?)", pathdata)
+            pathdata = deque(point_token_re.findall(pathdata))
+            pop = pathdata.popleft
             def pnext():
-                return (float(pathdata.pop(0)), float(pathdata.pop(0)))
+                return (float(pop()), float(pop()))
             self.new_path()
             while pathdata:
                 self.line_to(*pnext())
@@ -581,7 +746,8 @@ class SVG_pre_render(object):
                 self.n_tris += len(tris)/3
                 if isinstance(fill, str):
                     g = self.gradients[fill]
-                    fills = [g.interp(x) for x in tris]
+                    flat = g.interp_all(tris)
+                    fills = [flat[i:i+4] for i in xrange(0, len(flat), 4)]
                 else:
                     fills = [fill for x in tris]
                 #pyglet.graphics.draw(len(tris), GL_TRIANGLES, 
@@ -601,7 +767,8 @@ class SVG_pre_render(object):
                         loop_plus += [loop[i], loop[i+1]]
                     if isinstance(stroke, str):
                         g = self.gradients[stroke]
-                        strokes = [g.interp(x) for x in loop_plus]
+                        flat = g.interp_all(loop_plus)
+                        strokes = [flat[i:i+4] for i in xrange(0, len(flat), 4)]
                     else:
                         strokes = [stroke for x in loop_plus]
                     #pyglet.graphics.draw(len(loop_plus), GL_LINES, 
@@ -614,6 +781,57 @@ class SVG_pre_render(object):
                         glVertex3f(vtx[0], vtx[1], 0)
                     glEnd()                     
 
+    def build_arrays(self):
+        """Same geometry and draw order as render_slowly, packed into
+        self.vertices (GLfloat) and self.colors (GLubyte).
+        Consecutive primitives of the same type are merged in self.runs.
+        """
+        self.n_tris = 0
+        self.n_lines = 0
+        points = []
+        colors = []
+        self.runs = []
+        def add(mode, transform, pts, clrs):
+            if not pts:
+                return
+            a, b, c, d, e, f = transform.values
+            first = len(points)
+            points.extend([(a*x + c*y + e, b*x + d*y + f) for x, y in pts])
+            colors.extend(clrs)
+            if self.runs and self.runs[-1][0] == mode:
+                self.runs[-1][2] += len(pts)
+            else:
+                self.runs.append([mode, first, len(pts)])
+
+        for path, stroke, tris, fill, transform in self.paths:
+            if tris:
+                self.n_tris += len(tris)/3
+                if isinstance(fill, str):
+                    g = self.gradients[fill]
+                    fills = g.interp_all(tris)
+                else:
+                    fills = fill * len(tris)
+                add(GL_TRIANGLES, transform, tris, fills)
+            if path:
+                for loop in path:
+                    self.n_lines += len(loop) - 1
+                    loop_plus = [None] * (2 * (len(loop) - 1))
+                    loop_plus[0::2] = loop[:-1]
+                    loop_plus[1::2] = loop[1:]
+                    if isinstance(stroke, str):
+                        g = self.gradients[stroke]
+                        strokes = g.interp_all(loop_plus)
+                    else:
+                        strokes = stroke * len(loop_plus)
+                    add(GL_LINES, transform, loop_plus, strokes)
+
+        flat = [0.0] * (2 * len(points))
+        flat[0::2] = [x for x, y in points]
+        flat[1::2] = [y for x, y in points]
+        self.vertices = (GLfloat * len(flat))(*flat)
+        self.colors = (GLubyte * len(colors))(*colors)
+        self.runs = [tuple(run) for run in self.runs]
+
     def calc_bounds(self):
         vertexes = []
         for path, stroke, tris, fill, transform in self.paths:
@@ -757,21 +975,14 @@ class SVG_pre_render(object):
 
         @set_tess_callback(GLU_TESS_END)
         def endCallback():
+            shape = self.curr_shape
             if self.tess_style == GL_TRIANGLE_FAN:
-                c = self.curr_shape.pop(0)
-                p1 = self.curr_shape.pop(0)
-                while self.curr_shape:
-                    p2 = self.curr_shape.pop(0)
+                c = shape[0]
+                for p1, p2 in zip(shape[1:], shape[2:]):
                     tlist.extend([c, p1, p2])
-                    p1 = p2
             elif self.tess_style == GL_TRIANGLE_STRIP:
-                p1 = self.curr_shape.pop(0)
-                p2 = self.curr_shape.pop(0)
-                while self.curr_shape:
-                    p3 = self.curr_shape.pop(0)
+                for p1, p2, p3 in zip(shape, shape[1:], shape[2:]):
                     tlist.extend([p1, p2, p3])
-                    p1 = p2
-                    p2 = p3
             elif self.tess_style == GL_TRIANGLES:
                 tlist.extend(self.curr_shape)
             else:
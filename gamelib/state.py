@@ -6,8 +6,14 @@ class State( object ):
 
     STATE_PAUSE, STATE_PLAY, STATE_WIN, STATE_OVER = range(4)
 
+    # changes to these attributes are notified to the observers
+    OBSERVED = ( 'score', 'lives', 'farts', 'coins', 'level_idx' )
+
     def __init__( self ):
 
+        # callables called with (name, value) when an OBSERVED attribute changes
+        self.observers = []
+
         # current score
         self.score = 0
 
@@ -51,4 +57,21 @@ class State( object ):
         self.coins = 0
         self.farts = 10
 
+    def add_observer( self, callback ):
+        self.observers.append( callback )
+
+    def remove_observer( self, callback ):
+        if callback in self.observers:
+            self.observers.remove( callback )
+
+    def __setattr__( self, name, value ):
+        if name in self.OBSERVED:
+            old = self.__dict__.get( name )
+            object.__setattr__( self, name, value )
+            if old != value:
+                for callback in list( self.observers ):
+                    callback( name, value )
+        else:
+            object.__setattr__( self, name, value )
+
 state = State()
@@ -1,4 +1,5 @@
 
+import os
 from Box2D import *
 import data
 import cocos
@@ -6,11 +7,96 @@ import squirtle
 import math
 
 from xml.dom.minidom import parse, parseString
+from xml.etree.cElementTree import iterparse
 
 DEFAULT_FRICTION = 2
 DEFAULT_RESTITUTION = 0.2
 DEFAULT_DENSITY = 1
 
+# compiled level operations
+OP_BODY, OP_SHAPE, OP_MASS, OP_CALLBACK = range(4)
+
+# shape types
+SHAPE_BOX, SHAPE_CIRCLE = range(2)
+
+# (path, mtime, ratio) -> CompiledLevel
+compiled_levels = {}
+
+SVG_NS = 'http://www.w3.org/2000/svg'
+NAMESPACES = {
+    'inkscape' : 'http://www.inkscape.org/namespaces/inkscape',
+    'sodipodi' : 'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd',
+    }
+SVG_G = '{%s}g' % SVG_NS
+INKSCAPE_LABEL = '{%s}label' % NAMESPACES['inkscape']
+
+class CompiledLevel( object ):
+    '''The result of parsing a level svg: the list of operations needed to
+    build the level in a b2World, in document order.
+
+    The operations are plain tuples, so they are cheap to keep around:
+        (OP_BODY, position, angle)
+        (OP_SHAPE, body_idx, (SHAPE_BOX, hx, hy, center, angle, properties) )
+        (OP_SHAPE, body_idx, (SHAPE_CIRCLE, radius, properties) )
+        (OP_MASS, body_idx)
+        (OP_CALLBACK, body_idx, game_data)
+    body_idx is the order of creation of the body, or None.
+    properties is a list of (key,value) to set in the shape definition.
+    '''
+
+    def __init__( self ):
+        self.ops = []
+        self.n_bodies = 0
+
+    def create_body( self, position, angle=0 ):
+        self.ops.append( (OP_BODY, (position[0], position[1]), angle) )
+        self.n_bodies += 1
+        return self.n_bodies - 1
+
+    def create_shape( self, body_idx, shape ):
+        self.ops.append( (OP_SHAPE, body_idx, shape) )
+
+    def set_mass_from_shapes( self, body_idx ):
+        self.ops.append( (OP_MASS, body_idx) )
+
+    def add_callback( self, body_idx, game_data ):
+        self.ops.append( (OP_CALLBACK, body_idx, game_data) )
+
+    def build( self, world, callback=None ):
+        '''creates the bodies in world. Returns the list of created bodies'''
+        bodies = []
+        for op in self.ops:
+            if op[0] == OP_BODY:
+                bd = b2BodyDef()
+                bd.position = op[1]
+                bd.angle = op[2]
+                bodies.append( world.CreateBody(bd) )
+            elif op[0] == OP_SHAPE:
+                bodies[ op[1] ].CreateShape( self.build_shape_def( op[2] ) )
+            elif op[0] == OP_MASS:
+                bodies[ op[1] ].SetMassFromShapes()
+            elif op[0] == OP_CALLBACK:
+                if callback:
+                    body = None
+                    if op[1] is not None:
+                        body = bodies[ op[1] ]
+                    callback( body, op[2] )
+        return bodies
+
+    def build_shape_def( self, shape ):
+        if shape[0] == SHAPE_BOX:
+            type, hx, hy, center, angle, properties = shape
+            sd = b2PolygonDef()
+            sd.SetAsBox( hx, hy, center, angle )
+        else:
+            type, radius, properties = shape
+            sd = b2CircleDef()
+            sd.radius = radius
+        for key,value in properties:
+            setattr( sd, key, value )
+        return sd
+
+
 class SVGBox2dParser( object ):
 
     def __init__( self, world, level, ratio=30, callback=None ):
@@ -22,6 +108,7 @@ class SVGBox2dParser( object ):
         self.svg_size = b2Vec2(0,0)
 
 
+        self.compiled = None
         self.current_body = None
         self.static_physics = True
 #        self.transform = squirtle.Matrix([1,0,0,-1,0,0])
@@ -29,7 +116,26 @@ class SVGBox2dParser( object ):
 
 
     def parse( self ):
-        dom1 = parse( data.filepath( self.level) )
+        self.compile().build( self.world, self.callback )
+
+    def compile( self ):
+        '''returns the CompiledLevel of the level.
+        The svg is parsed only if it is not in the cache, or if it changed'''
+        path = data.filepath( self.level )
+        key = (path, os.path.getmtime( path ), self.ratio)
+        if key not in compiled_levels:
+            # forget the older versions of the level
+            for old_key in compiled_levels.keys():
+                if old_key[0] == path:
+                    del compiled_levels[ old_key ]
+            compiled_levels[ key ] = self.parse_svg( path )
+        return compiled_levels[ key ]
+
+    def parse_svg( self, path ):
+        '''parses the svg file. Returns a new CompiledLevel'''
+        self.compiled = CompiledLevel()
+
+        dom1 = parse( path )
         main = dom1.getElementsByTagName("svg")[0]
         groups = main.getElementsByTagName("g")
 
@@ -40,6 +146,7 @@ class SVGBox2dParser( object ):
         for group in groups:
             self.parse_main_group( group )
 
+        return self.compiled
 
     def parse_main_group( self, group ):
         label = group.getAttribute('inkscape:label')
@@ -109,25 +216,22 @@ class SVGBox2dParser( object ):
 #        sd.setVertices(vertices)
 
 
-        sd=b2PolygonDef()
-        sd.SetAsBox(width/2,height/2,(width/2,height/2),0)
-        self.apply_physics_properties_to_shape( node, sd ) 
+        properties = self.get_physics_properties( node )
+        sd = (SHAPE_BOX, width/2, height/2, (width/2,height/2), 0, properties)
 
-        if not self.current_body:
-            bd = b2BodyDef()
-            bd.angle = -angle
-            bd.position = b2Vec2(rel_pos.x, rel_pos.y)
-            body = self.world.CreateBody(bd)
+        if self.current_body is None:
+            body = self.compiled.create_body( (rel_pos.x, rel_pos.y), -angle )
         else:
             body = self.current_body
 
-        body.CreateShape(sd)
+        self.compiled.create_shape( body, sd )
 
         self.apply_physics_properties_to_body( body ) 
 
         return body
 
     def parse_path( self, node ):
+        body = None
         subtype = node.getAttribute('sodipodi:type')
         if subtype == 'arc':
             cx = float( node.getAttribute('sodipodi:cx') )
@@ -151,16 +255,13 @@ class SVGBox2dParser( object ):
             scale_y = matrix.values[3]
             radius = math.sqrt( rx * scale_x * ry * scale_y ) / self.ratio
 
-            sd=b2CircleDef()
-            sd.radius = radius
-            self.apply_physics_properties_to_shape( node, sd ) 
-            if not self.current_body:
-                bd=b2BodyDef()
-                bd.position = rel_pos
-                body = self.world.CreateBody(bd)
+            properties = self.get_physics_properties( node )
+            sd = (SHAPE_CIRCLE, radius, properties)
+            if self.current_body is None:
+                body = self.compiled.create_body( (rel_pos.x, rel_pos.y) )
             else:
                 body = self.current_body
-            body.CreateShape(sd)
+            self.compiled.create_shape( body, sd )
             self.apply_physics_properties_to_body( body )
 
         return body
@@ -172,9 +273,8 @@ class SVGBox2dParser( object ):
         old_transform = self.transform
         self.transform = self.transform * matrix
 
-        bd = b2BodyDef()
-        bd.position = b2Vec2( self.transform.values[4], self.transform.values[5] )
-        self.current_body = self.world.CreateBody(bd)
+        position = ( self.transform.values[4], self.transform.values[5] )
+        self.current_body = self.compiled.create_body( position )
 
         self.parse_elements( node )
 
@@ -209,11 +309,13 @@ class SVGBox2dParser( object ):
             ret = float(value)
         return ret
 
-    def apply_physics_properties_to_shape( self, node, shape ):
-
-        shape.restitution = DEFAULT_RESTITUTION
-        shape.density = DEFAULT_DENSITY
-        shape.friction = DEFAULT_FRICTION
+    def get_physics_properties( self, node ):
+        # list of (key,value) to be set in the shape definition
+        properties = [
+            ('restitution', DEFAULT_RESTITUTION),
+            ('density', DEFAULT_DENSITY),
+            ('friction', DEFAULT_FRICTION),
+            ]
 
         data = node.getAttribute('physics_shape' )
 
@@ -222,14 +324,87 @@ class SVGBox2dParser( object ):
             for keyvalue in keyvalues:
                 key,value = keyvalue.split('=')
                 value = self.cast_value( value )
-                setattr( shape, key, value )
+                properties.append( (key, value) )
+
+        return properties
 
 
     def apply_physics_properties_to_body( self, body ):
         if not self.static_physics:
-            body.SetMassFromShapes()
+            self.compiled.set_mass_from_shapes( body )
 
     def apply_callback( self, node, body ):
         game_data = node.getAttribute('game_data')
-        if game_data and self.callback:
-            self.callback( body, game_data )
+        if game_data:
+            self.compiled.add_callback( body, game_data )
+
+
+class ElementAdaptor( object ):
+    '''Gives a cElementTree element the few minidom methods used by
+    SVGBox2dParser'''
+
+    def __init__( self, element ):
+        self.element = element
+
+        tag = element.tag
+        if tag.startswith( '{%s}' % SVG_NS ):
+            tag = tag[ len(SVG_NS)+2: ]
+        self.nodeName = tag
+
+    def getAttribute( self, name ):
+        if ':' in name:
+            prefix, name = name.split(':')
+            name = '{%s}%s' % ( NAMESPACES[prefix], name )
+        return self.element.get( name, '' )
+
+    @property
+    def childNodes( self ):
+        return [ ElementAdaptor(e) for e in self.element ]
+
+
+class SVGBox2dIterParser( SVGBox2dParser ):
+    '''Same as SVGBox2dParser, but the svg is read with cElementTree.iterparse.
+
+    Only the physics groups are kept in memory (until they are parsed),
+    the rest of the elements are freed as soon as they are read.
+    '''
+
+    def parse_svg( self, path ):
+        self.compiled = CompiledLevel()
+
+        parents = []
+        physics_groups = 0      # open physics groups
+        for event, element in iterparse( path, events=('start','end') ):
+            if event == 'start':
+                if not parents:
+                    width = element.get('width')
+                    height = element.get('height')
+                    self.svg_size = b2Vec2( float(width), float(height) )
+                if self.is_physics_group( element ):
+                    physics_groups += 1
+                parents.append( element )
+                continue
+
+            parents.pop()
+            if self.is_physics_group( element ):
+                physics_groups -= 1
+                if physics_groups == 0:
+                    # same order as getElementsByTagName: the group, then its subgroups
+                    for group in element.getiterator( SVG_G ):
+                        self.parse_main_group( ElementAdaptor(group) )
+
+            # not needed anymore
+            if physics_groups == 0 and parents:
+                parents[-1].remove( element )
+
+        return self.compiled
+
+    def is_physics_group( self, element ):
+        return element.tag == SVG_G and element.get( INKSCAPE_LABEL, '' ).startswith('physics:')
+
+
+# parser backends
+parsers = {
+    'minidom' : SVGBox2dParser,
+    'iterparse' : SVGBox2dIterParser,
+    }